@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the stages of an EchelleDataTools reduction on
+synthetic nights written by synthetic_night.py.
+
+    python benchmarks/run_benchmarks.py --quick --save baseline.json
+    python benchmarks/run_benchmarks.py --quick --compare baseline.json
+
+Each case runs in a fresh process, so imports, caches and
+memory high-water marks don't carry over between cases. Its
+setup (e.g. loading the frames a combine needs) is not
+timed. The wall time is the best of --repeat runs, and the
+peak RSS is the largest growth of the process's resident
+memory over the timed part of any run, plus the peak of any
+worker processes it started.
+
+Results are saved as JSON. With --compare, each case is
+matched by name against a saved baseline, and the run exits
+with status 1 if any case is slower or uses more memory than
+the baseline by more than --tolerance.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import synthetic_night
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Format version of the results file.
+RESULTS_VERSION = 1
+
+
+@dataclass
+class Case:
+    """
+    One benchmark: a variant of a stage, run on a night with
+    the given detector shape, number of bias frames, dtype and
+    compression, using workers workers.
+    """
+    stage : str
+    variant : str
+    shape : tuple = (2048, 2048)
+    frames : int = 10
+    workers : int = 1
+    dtype : str = 'uint16'
+    compression : str = None
+
+    @property
+    def name(self):
+        """
+        """
+        compression = f",compression={self.compression}" if self.compression else ''
+        return (f"{self.stage}:{self.variant}[shape={self.shape[0]}x{self.shape[1]},frames={self.frames},"
+                f"workers={self.workers},dtype={self.dtype}{compression}]")
+
+    @property
+    def nightName(self):
+        """
+        """
+        return f"night_{self.shape[0]}x{self.shape[1]}_{self.frames}_{self.dtype}_{self.compression or 'none'}"
+
+
+@dataclass
+class Result:
+    """
+    """
+    name : str
+    case : dict
+    wallTime : float
+    peakRssMB : float
+    childPeakRssMB : float
+    repeats : int = 1
+    times : list = field(default_factory=list)
+
+
+def buildCases(quick=False, stages=None):
+    """
+    Returns the cases to run. Every stage is run across the
+    scaling axes: number of frames, detector size, and
+    number of workers. --quick runs small nights only.
+    """
+
+    frameCounts = (4, 8) if quick else (10, 40)
+    shapes = ((256, 256),) if quick else ((1024, 1024), (2048, 2048))
+    workers = (1, 2) if quick else (1, 4)
+
+    cases = [
+            Case('import', 'package', shape=shapes[0], frames=frameCounts[0]),
+            Case('import', 'full', shape=shapes[0], frames=frameCounts[0]),
+            ]
+    for shape in shapes:
+        for frames in frameCounts:
+            night = dict(shape=shape, frames=frames)
+            for w in workers:
+                cases += [
+                        Case('scan', 'full', workers=w, **night),
+                        Case('scan', 'headerOnly', workers=w, **night),
+                        Case('load', 'eager', workers=w, **night),
+                        Case('combine', 'median', workers=w, **night),
+                        Case('combine', 'sigmaclip', workers=w, **night),
+                        Case('ttest', 'pixelwise', workers=w, **night),
+                        ]
+            cases += [
+                    Case('load', 'lazy', **night),
+                    Case('load', 'compact', **night),
+                    Case('load', 'eager', compression='RICE_1', **night),
+                    Case('combine', 'median', compression='RICE_1', **night),
+                    Case('combine', 'medianTiled', **night),
+                    Case('ttest', 'indep', **night),
+                    Case('ttest', 'permutation', **night),
+                    ]
+        for w in workers:
+            cases.append(Case('plot', 'imageAndHist', shape=shape, frames=frameCounts[0], workers=w))
+
+    if stages:
+        cases = [c for c in cases if c.stage in stages]
+    return cases
+
+
+def _stageImport(dataRoot, case):
+    """
+    Imports the package as a fresh worker process would, and
+    for 'full' its plot and statistics tools as well. numpy
+    and astropy.io.fits are already imported by the benchmark
+    itself, so this is the cost on top of those.
+    """
+    def run():
+        import EchelleDataTools
+        if case.variant == 'full':
+            return EchelleDataTools.EchellePlotTools, EchelleDataTools.EchelleStatsTools
+        return EchelleDataTools
+    return run
+
+
+def _stageScan(dataRoot, case):
+    """
+    """
+    from EchelleDataTools.EchelleDataSequenceConfiguration import EchelleDataSequenceConfiguration
+    return lambda: EchelleDataSequenceConfiguration(
+            dataRoot,
+            headerOnly=(case.variant == 'headerOnly'),
+            maxWorkers=case.workers,
+            )
+
+
+def _stageLoad(dataRoot, case):
+    """
+    """
+    from EchelleDataTools.EchelleDataSequence import EchelleDataSequence
+    from EchelleDataTools.EchelleDataSequenceConfiguration import EchelleDataSequenceConfiguration
+    config = EchelleDataSequenceConfiguration(dataRoot)
+
+    def run():
+        seq = EchelleDataSequence(config)
+        seq.loadFrames(
+                lazy=(case.variant == 'lazy'),
+                compact=(case.variant == 'compact'),
+                maxWorkers=case.workers,
+                )
+        return seq
+    return run
+
+
+def _loadBiasAndDark(dataRoot, **loadOptions):
+    """
+    """
+    from EchelleDataTools.EchelleDataSequence import EchelleDataSequence
+    seq = EchelleDataSequence(dataRoot)
+    seq.loadFrames(loadBlueFlatFrames=False, loadRedFlatFrames=False, loadWaveCalFrames=False,
+            loadObjectFrames=False, **loadOptions)
+    return seq
+
+
+def _stageCombine(dataRoot, case):
+    """
+    Every variant goes through makeSuperBias, so the workers
+    axis compares the same code path.
+    """
+    seq = _loadBiasAndDark(dataRoot, lazy=(case.compression is not None))
+    match case.variant:
+        case 'median':
+            return lambda: seq.makeSuperBias(maxWorkers=case.workers)
+        case 'medianTiled':
+            return lambda: seq.makeSuperBias(maxTileBytes=16 * (1 << 20))
+        case 'sigmaclip':
+            return lambda: seq.makeSuperBias(combineMethod='sigmaclip', maxWorkers=case.workers)
+    raise ValueError(f"Unknown combine variant {case.variant!r}")
+
+
+def _stageTtest(dataRoot, case):
+    """
+    """
+    from EchelleDataTools.EchelleStatsTools import EchelleStatsTools
+    seq = _loadBiasAndDark(dataRoot)
+    match case.variant:
+        case 'indep':
+            return lambda: EchelleStatsTools.EchelleTtestIndep(seq.biasFrames, seq.darkFrames)
+        case 'permutation':
+            return lambda: EchelleStatsTools.EchellePermutationIndep(
+                    seq.biasFrames, seq.darkFrames, nResamples=2000, seed=0, maxWorkers=case.workers)
+        case 'pixelwise':
+            return lambda: EchelleStatsTools.EchelleTtestPixelwise(seq.biasFrames, seq.darkFrames, maxWorkers=case.workers)
+    raise ValueError(f"Unknown t-test variant {case.variant!r}")
+
+
+def _stagePlot(dataRoot, case):
+    """
+    Renders an image and histogram figure of each bias frame.
+    """
+    from EchelleDataTools.EchellePlotTools import EchellePlotTools
+    seq = _loadBiasAndDark(dataRoot, lazy=True)
+    outputDir = tempfile.mkdtemp(prefix='echelle-bench-plots-')
+    jobs = [
+            EchellePlotTools.PlotJob(EchellePlotTools.plotImageAndHist, f, os.path.join(outputDir, f"bias{num}.png"),
+                {'fmt' : 'png', 'decimate' : True})
+            for num, f in enumerate(seq.biasFrames)
+            ]
+
+    def run():
+        try:
+            EchellePlotTools.renderPlotJobs(jobs, maxWorkers=case.workers)
+        finally:
+            shutil.rmtree(outputDir, ignore_errors=True)
+    return run
+
+
+STAGES = {
+        'import' : _stageImport,
+        'scan' : _stageScan,
+        'load' : _stageLoad,
+        'combine' : _stageCombine,
+        'ttest' : _stageTtest,
+        'plot' : _stagePlot,
+        }
+
+
+def _resetPeakRss():
+    """
+    Resets the process's resident memory high-water mark, if
+    the kernel supports it (Linux). Returns whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peakRssMB():
+    """
+    Returns the process's resident memory high-water mark.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    ## ru_maxrss is in kB on Linux, bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1 << 20)
+
+
+def _currentRssMB():
+    """
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _peakRssMB()
+
+
+def _runCase(case, dataRoot):
+    """
+    Runs one case in the current (fresh) process. Returns
+    (wall time in s, peak RSS growth in MB, peak RSS of any
+    worker processes in MB).
+    """
+    ## Stages import what they use, so the import stage times a cold import.
+    os.environ['MPLBACKEND'] = 'Agg'
+    logging.disable(logging.INFO)
+
+    timed = STAGES[case.stage](dataRoot, case)
+    _resetPeakRss()
+    startRss = _currentRssMB()
+    start = time.perf_counter()
+    result = timed()
+    wallTime = time.perf_counter() - start
+    peakRss = _peakRssMB() - startRss
+    del result
+
+    scale = 1 if sys.platform == 'darwin' else 1024
+    childPeakRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / (1 << 20)
+    return wallTime, peakRss, childPeakRss
+
+
+def runCases(cases, workDir, repeat=1):
+    """
+    Runs each case repeat times, each in a fresh spawned
+    process, writing the nights they need to workDir first.
+    Returns a list of Result.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for num, case in enumerate(cases):
+        dataRoot = _ensureNight(workDir, case)
+        times, peaks, childPeaks = [], [], []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                wallTime, peakRss, childPeakRss = executor.submit(_runCase, case, dataRoot).result()
+            times.append(wallTime)
+            peaks.append(peakRss)
+            childPeaks.append(childPeakRss)
+        result = Result(
+                name=case.name,
+                case=asdict(case),
+                wallTime=min(times),
+                peakRssMB=max(peaks),
+                childPeakRssMB=max(childPeaks),
+                repeats=repeat,
+                times=times,
+                )
+        print(f"[{num+1}/{len(cases)}] {result.name}: {result.wallTime:.3f} s, "
+                f"peak RSS +{result.peakRssMB:.1f} MB (workers {result.childPeakRssMB:.1f} MB)", flush=True)
+        results.append(result)
+    return results
+
+
+def _ensureNight(workDir, case):
+    """
+    Writes the night case needs to workDir, unless a complete
+    one is already there from an earlier case or run.
+    """
+    dataRoot = os.path.join(workDir, case.nightName)
+    marker = os.path.join(dataRoot, '.complete')
+    if not os.path.exists(marker):
+        shutil.rmtree(dataRoot, ignore_errors=True)
+        synthetic_night.writeNight(
+                dataRoot,
+                shape=tuple(case.shape),
+                counts=synthetic_night.nightCounts(case.frames),
+                dtype=case.dtype,
+                compression=case.compression,
+                )
+        open(marker, 'w').close()
+    return dataRoot
+
+
+def machineInfo():
+    """
+    """
+    import astropy
+    import numpy
+    return {
+            'platform' : platform.platform(),
+            'python' : platform.python_version(),
+            'numpy' : numpy.__version__,
+            'astropy' : astropy.__version__,
+            'cpuCount' : os.cpu_count(),
+            }
+
+
+def saveResults(fileName, results):
+    """
+    """
+    with open(fileName, 'w') as f:
+        json.dump({
+            'version' : RESULTS_VERSION,
+            'created' : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'machine' : machineInfo(),
+            'results' : [asdict(r) for r in results],
+            }, f, indent=2)
+
+
+def loadResults(fileName):
+    """
+    Returns the results saved in fileName, keyed by case name.
+    """
+    with open(fileName) as f:
+        saved = json.load(f)
+    if saved.get('version') != RESULTS_VERSION:
+        raise ValueError(f"{fileName} has results version {saved.get('version')}, not {RESULTS_VERSION}")
+    return {r['name'] : r for r in saved['results']}
+
+
+def compareResults(results, baseline, tolerance=0.25, minTime=0.05, minRssMB=5.0):
+    """
+    Prints how each result compares with the baseline, and
+    returns the names of the cases that regressed: more than
+    tolerance slower, or using more than tolerance more peak
+    memory. Times under minTime and memory under minRssMB are
+    too noisy to compare, and only differences above them
+    count.
+    """
+    regressions = []
+    print(f"{'case':<100} {'time':>8} {'base':>8} {'ratio':>6} {'rss':>8} {'base':>8} {'ratio':>6}")
+    for r in results:
+        base = baseline.get(r.name)
+        if base is None:
+            print(f"{r.name:<100} {r.wallTime:8.3f} {'-':>8} {'new':>6}")
+            continue
+        timeRatio = r.wallTime / max(base['wallTime'], 1e-9)
+        rssRatio = r.peakRssMB / max(base['peakRssMB'], 1e-9)
+        slower = (timeRatio > 1 + tolerance) and (r.wallTime - base['wallTime'] > minTime)
+        bigger = (rssRatio > 1 + tolerance) and (r.peakRssMB - base['peakRssMB'] > minRssMB)
+        flag = ' REGRESSION' if (slower or bigger) else ''
+        print(f"{r.name:<100} {r.wallTime:8.3f} {base['wallTime']:8.3f} {timeRatio:6.2f} "
+                f"{r.peakRssMB:8.1f} {base['peakRssMB']:8.1f} {rssRatio:6.2f}{flag}")
+        if slower or bigger:
+            regressions.append(r.name)
+    return regressions
+
+
+def main():
+    """
+    """
+    parser = argparse.ArgumentParser(description="Benchmark EchelleDataTools on synthetic nights.")
+    parser.add_argument('--quick', action='store_true', help="Small nights only.")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=None)
+    parser.add_argument('--filter', default=None, help="Only run cases whose name contains this text.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'EchelleDataTools-benchmarks'),
+            help="Where synthetic nights are written, and kept between runs.")
+    parser.add_argument('--save', default=None, help="Write results to this JSON file.")
+    parser.add_argument('--compare', default=None, help="Compare results with this saved JSON file.")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    cases = buildCases(quick=args.quick, stages=args.stages)
+    if args.filter:
+        cases = [c for c in cases if args.filter in c.name]
+    results = runCases(cases, args.workdir, repeat=args.repeat)
+
+    if args.save:
+        saveResults(args.save, results)
+        print(f"Saved {len(results)} results to {args.save}")
+
+    if args.compare:
+        regressions = compareResults(results, loadResults(args.compare), tolerance=args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} of {len(results)} cases regressed.")
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == '__main__':
+    main()
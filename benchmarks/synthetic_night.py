@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Writes a synthetic night of Echelle frames for benchmarking.
+
+    python benchmarks/synthetic_night.py DATAROOT --shape 2048 2048 --frames 20 --compression RICE_1
+
+Every frame has the IMAGETYP, FILTER, EXPTIME, DATE-OBS and
+CCDTEMP cards EchelleDataSequenceConfiguration classifies and
+indexes frames by. With an overscan, BIASSEC, DATASEC and
+TRIMSEC cards describe the strips of columns at the right
+edge of the detector.
+"""
+
+import argparse
+import astropy.io.fits as fits
+import datetime
+import logging
+import numpy as np
+import os
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Frames per (IMAGETYP, FILTER) of a default night.
+DEFAULT_COUNTS = {
+        ('ZERO', 'OPEN') : 10,
+        ('DARK', 'OPEN') : 5,
+        ('FLAT', 'BLUE') : 5,
+        ('FLAT', 'OPEN') : 5,
+        ('COMP', 'OPEN') : 3,
+        ('OBJECT', 'OPEN') : 3,
+        }
+
+## Exposure times, and signal in DN/s above the bias, by IMAGETYP.
+EXPOSURES = {
+        'ZERO' : (0.0, 0.0),
+        'DARK' : (600.0, 0.02),
+        'FLAT' : (10.0, 1500.0),
+        'COMP' : (30.0, 50.0),
+        'OBJECT' : (900.0, 5.0),
+        }
+
+BIAS_LEVEL = 1000.0
+READ_NOISE = 5.0
+
+## Stored data types a night can be written in.
+DTYPES = ('uint16', 'int16', 'int32', 'float32')
+
+## Tile compressions, written as .fits.fz files holding the frame in a CompImageHDU.
+TILE_COMPRESSIONS = ('RICE_1', 'GZIP_1', 'GZIP_2', 'PLIO_1', 'HCOMPRESS_1')
+
+
+def nightCounts(frames):
+    """
+    Returns DEFAULT_COUNTS scaled to frames bias frames,
+    keeping at least one frame of every kind.
+    """
+
+    scale = frames / DEFAULT_COUNTS[('ZERO', 'OPEN')]
+    return {key : max(1, round(n * scale)) for key, n in DEFAULT_COUNTS.items()}
+
+
+def writeNight(dataRoot, shape=(2048, 2048), counts=None, dtype='uint16', bzero=None, bscale=None,
+        compression=None, overscan=0, seed=0):
+    """
+    Writes a night of frames to dataRoot, and returns the list
+    of files written.
+
+    shape is the (rows, cols) of the detector, including
+    overscan columns. counts maps (IMAGETYP, FILTER) to a
+    number of frames, defaulting to DEFAULT_COUNTS. dtype is
+    one of DTYPES; 'uint16' is stored as int16 with a BZERO of
+    32768, as astropy writes it. bzero and bscale, if given,
+    scale the integer dtypes explicitly instead. compression
+    is None, one of TILE_COMPRESSIONS for .fits.fz files, or
+    'gzip' for .fits.gz files.
+    """
+
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}, not {dtype!r}")
+    if (compression is not None) and (compression not in TILE_COMPRESSIONS + ('gzip',)):
+        raise ValueError(f"compression must be None, 'gzip' or one of {TILE_COMPRESSIONS}, not {compression!r}")
+
+    os.makedirs(dataRoot, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    counts = counts or DEFAULT_COUNTS
+    extension = {None : '.fits', 'gzip' : '.fits.gz'}.get(compression, '.fits.fz')
+    start = datetime.datetime(2025, 8, 18, 1, 0, 0)
+
+    ## A fixed bias structure and flat field response, shared by every frame.
+    rows, cols = shape
+    biasPattern = BIAS_LEVEL + 2.0*np.sin(np.linspace(0, 4*np.pi, cols))[np.newaxis, :]
+    response = 1.0 - 0.1*np.linspace(-1, 1, rows)[:, np.newaxis]**2
+
+    written = []
+    num = 0
+    for (imageType, filterType), n in counts.items():
+        exptime, rate = EXPOSURES[imageType]
+        for _ in range(n):
+            fileName = os.path.join(dataRoot, f"synth{num:04d}{extension}")
+            num += 1
+
+            signal = rate * exptime * response
+            data = biasPattern + rng.normal(0.0, READ_NOISE, shape)
+            if rate > 0:
+                data += rng.poisson(np.broadcast_to(signal, shape)).astype(np.float64)
+            if overscan:
+                data[:, cols - overscan:] = biasPattern[:, cols - overscan:] + rng.normal(0.0, READ_NOISE, (rows, overscan))
+
+            header = fits.Header()
+            header['IMAGETYP'] = imageType
+            header['FILTER'] = filterType
+            header['EXPTIME'] = exptime
+            header['DATE-OBS'] = (start + datetime.timedelta(minutes=15*num)).isoformat()
+            header['CCDTEMP'] = round(float(rng.normal(-110.0, 0.2)), 2)
+            if overscan:
+                header['BIASSEC'] = f"[{cols - overscan + 1}:{cols},1:{rows}]"
+                header['DATASEC'] = f"[1:{cols - overscan},1:{rows}]"
+                header['TRIMSEC'] = header['DATASEC']
+
+            _writeFrame(fileName, data, header, dtype, bzero, bscale, compression)
+            written.append(fileName)
+
+    logger.info(f"Wrote {len(written)} frames of shape {shape} to {dataRoot}")
+    return written
+
+
+def _writeFrame(fileName, data, header, dtype, bzero, bscale, compression):
+    """
+    """
+    tiled = compression in TILE_COMPRESSIONS
+    if dtype == 'float32':
+        hdu = (fits.CompImageHDU if tiled else fits.PrimaryHDU)(data.astype(np.float32), header)
+    elif (bzero is not None) or (bscale is not None):
+        hdu = (fits.CompImageHDU if tiled else fits.PrimaryHDU)(data, header)
+        hdu.scale(dtype, bzero=bzero or 0, bscale=bscale or 1)
+    else:
+        info = np.iinfo(dtype)
+        values = np.clip(np.rint(data), info.min, info.max).astype(dtype)
+        hdu = (fits.CompImageHDU if tiled else fits.PrimaryHDU)(values, header)
+
+    if tiled:
+        hdu.compression_type = compression
+        hdul = fits.HDUList([fits.PrimaryHDU(), hdu])
+    else:
+        hdul = fits.HDUList([hdu])
+    hdul.writeto(fileName, overwrite=True)
+
+
+def main():
+    """
+    """
+    parser = argparse.ArgumentParser(description="Write a synthetic night of Echelle frames.")
+    parser.add_argument('dataRoot')
+    parser.add_argument('--shape', type=int, nargs=2, default=(2048, 2048), metavar=('ROWS', 'COLS'))
+    parser.add_argument('--frames', type=int, default=None,
+            help="Number of bias frames; the other kinds are scaled to match.")
+    parser.add_argument('--dtype', choices=DTYPES, default='uint16')
+    parser.add_argument('--bzero', type=float, default=None)
+    parser.add_argument('--bscale', type=float, default=None)
+    parser.add_argument('--compression', choices=TILE_COMPRESSIONS + ('gzip',), default=None)
+    parser.add_argument('--overscan', type=int, default=0, help="Columns of overscan at the right edge.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    writeNight(
+            args.dataRoot,
+            shape=tuple(args.shape),
+            counts=nightCounts(args.frames) if args.frames else None,
+            dtype=args.dtype,
+            bzero=args.bzero,
+            bscale=args.bscale,
+            compression=args.compression,
+            overscan=args.overscan,
+            seed=args.seed,
+            )
+
+
+if __name__ == '__main__':
+    main()
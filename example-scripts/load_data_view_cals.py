@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-from EchelleDataTools import EchelleDataSequence, EchellePlotTools
+from EchelleDataTools import EchelleDataSequence, EchellePlotTools, configureLogging
 
+configureLogging()
 
 DATA = 'data/Q3APO/UT250716/ajt/'
 
@@ -3,18 +3,145 @@
 __all__ = ['EchelleDataSequence']
 
 
-from .EchelleDataSequenceConfiguration import EchelleDataSequenceConfiguration
-from .Frame import Frame, SuperFrame
+from .EchelleDataSequenceConfiguration import EchelleDataSequenceConfiguration, _imageHDUIndex
+from .Frame import Frame, FrameResidencyPool, LazyFrame, SuperFrame
+from .SuperFrameCache import SuperFrameCache
+from .FrameRegion import parseRegion, regionSection, resolveRegion, subRegion
+from .FrameCube import readFrameCube, writeFrameCube
+from .FrameQA import FrameQATable, frameMetrics
+from .FrameCombine import combineParallel, combineTiled, compactStackDtype, frameData, getReducer, medianReducer, DEFAULT_MAX_TILE_BYTES
+from .Instrumentation import addToStage, headerBytes, stage
 
 import astropy.io.fits as fits
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field, InitVar
+from functools import partial
 import logging
 import numpy as np
+import os
 
 
 logger = logging.getLogger(f"{__name__}")
 
 
+## Frame categories: their name for frame cubes and the header index, their EchelleDataSequence frame list, and their label.
+FRAME_CATEGORIES = (
+        ('bias', 'biasFrames', 'Bias'),
+        ('dark', 'darkFrames', 'Dark'),
+        ('blueFlat', 'blueFlatFrames', 'Blue Flat'),
+        ('redFlat', 'redFlatFrames', 'Red Flat'),
+        ('waveCal', 'waveCalFrames', 'Wave Cal'),
+        ('object', 'objectFrames', 'Object'),
+        )
+
+## Names of the super frames of each category made by makeSuperFrames, before their group.
+SUPER_FRAME_NAMES = {
+        'bias' : 'super bias',
+        'dark' : 'super dark',
+        'blueFlat' : 'blue super flat',
+        'redFlat' : 'red super flat',
+        'waveCal' : 'super wave cal',
+        'object' : 'super object',
+        }
+
+
+def _openImageHDU(hdul, file):
+    """
+    Returns the index of the HDU holding the frame in hdul,
+    and the HDU itself.
+    """
+
+    index = _imageHDUIndex(hdul)
+    if index is None:
+        raise ValueError(f"{file} doesn't contain a PrimaryHDU object.")
+    return index, hdul[index]
+
+
+def _readFrame(file, lazy=False, compact=False, region=None):
+    """
+    Returns the header and data of the frame in file, the
+    index of its HDU, whether it is tile compressed, and the
+    region read. With lazy, only the header is read and data
+    is None. With compact, data is left unscaled by BZERO and
+    BSCALE. With region (see FrameRegion.parseRegion), only
+    that region is read, through the HDU's section.
+    """
+
+    with fits.open(file, do_not_scale_image_data=compact) as hdul:
+        index, hdu = _openImageHDU(hdul, file)
+        header = hdu.header
+        if region is not None:
+            region = resolveRegion(parseRegion(region, header), (header['NAXIS2'], header['NAXIS1']))
+        if lazy:
+            data = None
+        else:
+            data = hdu.data if region is None else hdu.section[region]
+        compressed = isinstance(hdu, fits.CompImageHDU)
+    return header, data, index, compressed, region
+
+
+def _readFrameData(file):
+    """
+    Returns the header and data of the frame in file, read
+    fully into memory.
+    """
+
+    with fits.open(file, memmap=False) as hdul:
+        _, hdu = _openImageHDU(hdul, file)
+        return hdu.header, hdu.data
+
+
+def _writeFrame(file, data, header, overwrite=False):
+    """
+    """
+
+    fits.PrimaryHDU(data=data, header=header).writeto(file, overwrite=overwrite)
+
+
+def _exposureTime(frames):
+    """
+    Returns the EXPTIME shared by frames, or None if they
+    don't all have one, or the same one.
+    """
+
+    times = {
+            f.header.get('EXPTIME') if getattr(f, 'header', None) is not None else None
+            for f in frames
+            }
+    if len(times) != 1:
+        return None
+    exposureTime = times.pop()
+    if isinstance(exposureTime, (int, float)) and not isinstance(exposureTime, bool):
+        return float(exposureTime)
+    return None
+
+
+def _scaledCorrection(bias, dark, scale=1.0):
+    """
+    Returns bias + scale*dark, either of which may be None.
+    """
+
+    if dark is None:
+        return bias
+    if scale != 1:
+        dark = scale*dark
+    return dark if bias is None else bias + dark
+
+
+def _calibratedFileName(file, suffix):
+    """
+    Returns the base name of file with suffix added before
+    the FITS extension. Output is always uncompressed.
+    """
+
+    base = os.path.basename(file)
+    for ext in ('.fz', '.gz', '.bz2'):
+        if base.lower().endswith(ext):
+            base = base[:-len(ext)]
+    root, ext = os.path.splitext(base)
+    return f"{root}{suffix}{ext or '.fits'}"
+
+
 @dataclass
 class EchelleDataSequence:
     dataRoot : InitVar[str]
@@ -29,12 +156,24 @@ class EchelleDataSequence:
     superDarkFrame: SuperFrame = field( init=False, repr=False )
     superBlueFlatFrame: SuperFrame = field( init=False, repr=False )
     superRedFlatFrame: SuperFrame = field( init=False, repr=False )
+    residencyPool : FrameResidencyPool = field( default=None, init=False, repr=False )
+    superFrameCache : SuperFrameCache = field( default=None, repr=False )
+    frameCubes : dict = field( default_factory=dict, init=False, repr=False )
+    frameQA : FrameQATable = field( default=None, init=False, repr=False )
+    superFrameGroups : dict = field( default_factory=dict, init=False, repr=False )
 
 
     def __post_init__(self, dataRoot):
         """
+        dataRoot is either the data directory, or an already
+        built EchelleDataSequenceConfiguration, e.g. one made
+        with non-default scan options.
         """
 
+        if isinstance(dataRoot, EchelleDataSequenceConfiguration):
+            self.echelleDataSequenceConfiguration = dataRoot
+            return
+
         try:
             self.echelleDataSequenceConfiguration = EchelleDataSequenceConfiguration(dataRoot)
         except Exception as e:
@@ -42,219 +181,873 @@ class EchelleDataSequence:
             raise e
 
 
+    @property
+    def headerIndex(self):
+        """
+        The HeaderIndex of the scanned files, from the
+        configuration.
+        """
+        return self.echelleDataSequenceConfiguration.headerIndex
+
+
+    def selectFrames(self, mask, categories=None):
+        """
+        Returns the loaded frames, of every category or of those
+        named in categories, whose files are in the rows of
+        headerIndex where mask is true. mask is a boolean array
+        of one value per row, or a function of the index
+        returning one, e.g. the darks of 600s taken after 03:00 UT
+        on the night of 2025-08-17:
+
+            sequence.selectFrames(
+                    lambda index: (index['EXPTIME'] == 600)
+                            & (index['DATE-OBS'] >= np.datetime64('2025-08-18T03:00')),
+                    categories=['dark'])
+        """
+
+        index = self.headerIndex
+        ## Frames not in the index have row -1, which picks the False appended to the mask.
+        selected = np.append(index._mask(mask), False)
+        frames = []
+        for _, frameAttr, _ in self._frameCategories(categories):
+            categoryFrames = getattr(self, frameAttr)
+            rows = index.rows([f.fileName for f in categoryFrames])
+            frames += [f for f, keep in zip(categoryFrames, selected[rows]) if keep]
+        return frames
+
+
+    def makeSuperFrames(self, category, groupBy, mask=None, biasSubtract=False, darkSubtract=False,
+            maxGroupWorkers=None, combineMethod='median', maxTileBytes=None, maxWorkers=1, outputDtype=None,
+            region=None, **combineOptions):
+        """
+        Makes one super frame of the loaded frames of category
+        (see FRAME_CATEGORIES) for each distinct value in
+        headerIndex of the card groupBy, or each distinct tuple
+        of values of a list of cards, e.g. one super dark per
+        exposure time:
+
+            superDarks = sequence.makeSuperFrames('dark', 'EXPTIME', biasSubtract=True)
+            superDarks[600]
+
+        mask limits the frames to rows of headerIndex, as for
+        selectFrames. Frames missing a value of groupBy, and
+        frames rejected by rejectFrames, are left out.
+
+        The groups are combined concurrently by a thread pool of
+        maxGroupWorkers threads (None for the executor default),
+        on top of any maxWorkers each combine uses. Corrections
+        are as for the make* methods: flats may be bias and dark
+        subtracted, other categories bias subtracted. See
+        makeSuperBias for the other options.
+
+        Returns a dict of the super frames by group value, also
+        kept in superFrameGroups[category]. Groups that can't be
+        combined, e.g. because all their frames are rejected, are
+        logged and left out.
+        """
+
+        (category, frameAttr, label), = self._frameCategories([category])
+        frames = getattr(self, frameAttr)
+        if self._listEmpty(frames):
+            logger.warning(f"No {label} frames are loaded. Nothing to do!")
+            raise ValueError(f"No {label} frames are loaded. Nothing to do!")
+
+        index = self.headerIndex
+        rows = index.rows([f.fileName for f in frames])
+        if (rows < 0).any():
+            logger.warning(f"Leaving {int((rows < 0).sum())} {label} frames that aren't in the header index out "
+                    "of the groups.")
+        frames = [f for f, row in zip(frames, rows) if row >= 0]
+        rows = rows[rows >= 0]
+        selected = None if mask is None else index._mask(mask)[rows]
+        groups = index.take(rows).groups(groupBy, mask=selected)
+        if not groups:
+            raise ValueError(f"No {label} frames have a value of {groupBy} to group them by.")
+
+        cards = [groupBy] if isinstance(groupBy, str) else list(groupBy)
+        makeGroup = partial(
+                self._makeCategorySuperFrame,
+                category,
+                biasSubtract=biasSubtract,
+                darkSubtract=darkSubtract,
+                region=region,
+                combineMethod=combineMethod,
+                maxTileBytes=maxTileBytes,
+                maxWorkers=maxWorkers,
+                outputDtype=outputDtype,
+                **combineOptions,
+                )
+        jobs = {}
+        for key, groupRows in groups.items():
+            values = key if len(cards) > 1 else (key,)
+            name = f"{SUPER_FRAME_NAMES[category]} " + ', '.join(f"{card}={value}" for card, value in zip(cards, values))
+            jobs[key] = (name, [frames[i] for i in groupRows])
+
+        superFrames = {}
+        with stage('group', f"{label} by {groupBy}", frames=len(frames)), \
+                ThreadPoolExecutor(max_workers=maxGroupWorkers) as executor:
+            futures = {key : executor.submit(makeGroup, groupFrames, name) for key, (name, groupFrames) in jobs.items()}
+            for key, future in futures.items():
+                try:
+                    superFrames[key] = future.result()
+                except ValueError as e:
+                    logger.warn(f"{jobs[key][0]} not generated: {e}")
+
+        logger.info(f"Made {len(superFrames)} {label} super frames grouped by {groupBy}.")
+        self.superFrameGroups[category] = superFrames
+        return superFrames
+
+
     def loadFrames(self,
             loadBiasFrames=True, loadDarkFrames=True, loadBlueFlatFrames=True, 
-            loadRedFlatFrames=True, loadWaveCalFrames=True, loadObjectFrames=True):
+            loadRedFlatFrames=True, loadWaveCalFrames=True, loadObjectFrames=True,
+            lazy=False, maxResidentBytes=None, maxWorkers=1, compact=False, region=None,
+            measure=False, saturation=None, overscan='BIASSEC'):
         """
+        With lazy, frames are made as LazyFrame objects that only
+        read their header now, and their data from a memory-mapped
+        file on first access. Their data is kept in residencyPool,
+        which drops the least recently used frames once more than
+        maxResidentBytes are in memory.
+
+        With maxWorkers > 1 (or None, for the executor default),
+        the files of every requested category are read by a
+        shared thread pool, so reads overlap across files and
+        categories. Frames are still added, named and checked
+        in the same order as a serial load.
+
+        With compact, frames keep their data as the raw integers
+        stored in the file, with BZERO and BSCALE kept on the
+        frame (see Frame.Frame), instead of being scaled to a
+        float array by astropy. The combine and statistics code
+        scales them a tile at a time. BLANK pixels are not
+        masked in compact frames.
+
+        Tile compressed .fits.fz files are read from their first
+        compressed image. Lazy frames of them decompress only
+        the tiles a tiled combine or statistic needs, unless
+        their whole data is accessed.
+
+        With region, only that part of each frame is read, e.g.
+        region='[1:100,1:2048]' or (slice(0, 2048), slice(0, 100)),
+        or region='BIASSEC' for the overscan section named in
+        each frame's header. See FrameRegion.parseRegion. Frames
+        record the region they hold in detector coordinates.
+
+        With measure, the frames loaded are measured by
+        measureFrames once they are all read, with saturation
+        and overscan, so frames can be rejected before any
+        combine.
         """
 
-        if loadBiasFrames:
-            try:
-                self._loadFrames( self.echelleDataSequenceConfiguration.biasList, self.biasFrames, 'Bias')
-            except ValueError as e:
-                logger.error(f"Bias list is empty: {e}")
-                raise e
-            except Exception as e:
-                logger.error(f"An error occurred while attempting to open a FITS file: {e}")
-                raise e
+        if lazy:
+            if self.residencyPool is None:
+                self.residencyPool = FrameResidencyPool(maxBytes=maxResidentBytes)
+            else:
+                self.residencyPool.maxBytes = maxResidentBytes
 
+        config = self.echelleDataSequenceConfiguration
+        categories = []
+        if loadBiasFrames:
+            categories.append( (config.biasList, self.biasFrames, 'Bias') )
         if loadDarkFrames:
-            try:
-                self._loadFrames( self.echelleDataSequenceConfiguration.darkList, self.darkFrames, 'Dark')
-            except ValueError as e:
-                logger.error(f"Dark list is empty: {e}")
-                raise e
-            except Exception as e:
-                logger.error(f"An error occurred while attempting to open a FITS file: {e}")
-                raise e
-
+            categories.append( (config.darkList, self.darkFrames, 'Dark') )
         if loadBlueFlatFrames:
-            try:
-                self._loadFrames( self.echelleDataSequenceConfiguration.blueFlatList, self.blueFlatFrames, 'Blue Flat')
-            except ValueError as e:
-                logger.error(f"Blue Flat list is empty: {e}")
-                raise e
-            except Exception as e:
-                logger.error(f"An error occurred while attempting to open a FITS file: {e}")
-                raise e
-            
+            categories.append( (config.blueFlatList, self.blueFlatFrames, 'Blue Flat') )
         if loadRedFlatFrames:
-            try:
-                self._loadFrames( self.echelleDataSequenceConfiguration.redFlatList, self.redFlatFrames, 'Red Flat')
-            except ValueError as e:
-                logger.error(f"Red Flat list is empty: {e}")
-                raise e
-            except Exception as e:
-                logger.error(f"An error occurred while attempting to open a FITS file: {e}")
-                raise e
-
+            categories.append( (config.redFlatList, self.redFlatFrames, 'Red Flat') )
         if loadWaveCalFrames:
-            try:
-                self._loadFrames( self.echelleDataSequenceConfiguration.waveCalList, self.waveCalFrames, 'Wave Cal')
-            except ValueError as e:
-                logger.error(f"Wave Cal list is empty: {e}")
-                raise e
-            except Exception as e:
-                logger.error(f"An error occurred while attempting to open a FITS file: {e}")
-                raise e
-
+            categories.append( (config.waveCalList, self.waveCalFrames, 'Wave Cal') )
         if loadObjectFrames:
-            try:
-                self._loadFrames( self.echelleDataSequenceConfiguration.objectList, self.objectFrames, 'Object')
-            except ValueError as e:
-                logger.error(f"Object list is empty: {e}")
-                raise e
-            except Exception as e:
-                logger.error(f"An error occurred while attempting to open a FITS file: {e}")
-                raise e
+            categories.append( (config.objectList, self.objectFrames, 'Object') )
 
+        executor = None
+        if (maxWorkers is None) or (maxWorkers > 1):
+            executor = ThreadPoolExecutor(max_workers=maxWorkers)
 
-    def makeSuperBias(self):
+        try:
+            ## Queue every read up front, so later categories load while earlier ones are collected.
+            pending = [
+                    [executor.submit(_readFrame, file, lazy, compact, region) for file in fileList] if executor else None
+                    for fileList, _, _ in categories
+                    ]
+            for (fileList, frameList, frameType), reads in zip(categories, pending):
+                try:
+                    with stage('load', frameType):
+                        self._loadFrames(fileList, frameList, frameType, lazy=lazy, pending=reads, compact=compact,
+                                region=region)
+                except ValueError as e:
+                    logger.error(f"{frameType} list is empty: {e}")
+                    raise e
+                except Exception as e:
+                    logger.error(f"An error occurred while attempting to open a FITS file: {e}")
+                    raise e
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        if measure:
+            labels = [frameType for _, _, frameType in categories]
+            self.measureFrames(
+                    categories=[c[0] for c in FRAME_CATEGORIES if c[2] in labels],
+                    saturation=saturation,
+                    overscan=overscan,
+                    maxWorkers=maxWorkers,
+                    )
+
+
+    def measureFrames(self, categories=None, saturation=None, overscan='BIASSEC', maxWorkers=1):
+        """
+        Measures the mean, median, std, min, max, saturated pixel
+        count and overscan level of every loaded frame, or of
+        those of the named categories (see FRAME_CATEGORIES), in
+        one pass over each frame's data. See FrameQA.frameMetrics
+        for saturation and overscan. With maxWorkers > 1 (or
+        None), frames are measured by a thread pool. Lazy frames
+        not in memory are read for the pass and dropped after
+        it, so no more than one frame per worker is in memory.
+
+        The metrics are kept in frameQA, a columnar FrameQATable,
+        which replaces the rows of frames measured before and
+        keeps which of them were rejected. Returns frameQA.
+        """
+
+        frames = []
+        labels = []
+        for _, frameAttr, label in self._frameCategories(categories):
+            frames += getattr(self, frameAttr)
+            labels += [label]*len(getattr(self, frameAttr))
+        if self._listEmpty(frames):
+            logger.warning("No frames are loaded to measure. Nothing to do!")
+            raise ValueError("No frames are loaded to measure. Nothing to do!")
+
+        measure = partial(frameMetrics, saturation=saturation, overscan=overscan)
+        with stage('qa', frames=len(frames)):
+            if (maxWorkers is None) or (maxWorkers > 1):
+                with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                    metrics = list(executor.map(measure, frames))
+            else:
+                metrics = [measure(f) for f in frames]
+
+        table = FrameQATable.fromMetrics(frames, labels, metrics)
+        if self.frameQA is not None:
+            measured = {id(f) for f in frames}
+            rejected = {id(f) for f, r in zip(self.frameQA.frames, self.frameQA.rejected) if r}
+            table.rejected[:] = [id(f) in rejected for f in frames]
+            kept = self.frameQA.select([id(f) not in measured for f in self.frameQA.frames])
+            table = FrameQATable.concatenate([kept, table])
+        self.frameQA = table
+        logger.info(f"Measured {len(frames)} frames.")
+        return table
+
+
+    def rejectFrames(self, mask):
+        """
+        Excludes the frames of the rows of frameQA where mask is
+        true from every later make* combine. mask is a boolean
+        array with one value per row, or a function of the table
+        returning one, e.g.
+
+            qa = sequence.frameQA
+            sequence.rejectFrames((qa['category'] == 'Red Flat') & (qa['saturated'] > 1000))
+            sequence.rejectFrames(lambda qa: qa['std'] > 3*np.median(qa['std']))
+
+        Returns the number of frames rejected in all.
         """
+
+        if self.frameQA is None:
+            logger.error("Frames must be measured by measureFrames before they can be rejected.")
+            raise ValueError("Frames must be measured by measureFrames before they can be rejected.")
+        mask = self.frameQA._mask(mask)
+        self.frameQA.rejected |= mask
+        for name in self.frameQA.name[mask]:
+            logger.info(f"Rejected frame {name}.")
+        return int(self.frameQA.rejected.sum())
+
+
+    def acceptFrames(self, mask=None):
+        """
+        Takes back the rejection of the frames of the rows of
+        frameQA where mask is true, or of every frame.
+        """
+
+        if self.frameQA is None:
+            return
+        if mask is None:
+            self.frameQA.rejected[:] = False
+        else:
+            self.frameQA.rejected &= ~self.frameQA._mask(mask)
+
+
+    def exportFrameCubes(self, cubeDir, categories=None):
+        """
+        Writes the frames of each loaded category, or of those
+        named in categories (e.g. ['bias', 'dark'], see
+        FRAME_CATEGORIES), into a contiguous frame cube in
+        cubeDir, e.g. cubeDir/bias.npy with its index of
+        headers and names in cubeDir/bias.json. See
+        FrameCube.writeFrameCube. Returns the cube files written.
+        """
+
+        written = []
+        for category, frameAttr, label in self._frameCategories(categories):
+            frames = getattr(self, frameAttr)
+            if self._listEmpty(frames):
+                if categories is not None:
+                    logger.warning(f"No {label} frames are loaded. Not writing a frame cube of them.")
+                continue
+            with stage('export', label, frames=len(frames)):
+                cubeFile, _ = writeFrameCube(os.path.join(cubeDir, category), frames, label=label)
+            written.append(cubeFile)
+        return written
+
+
+    def importFrameCubes(self, cubeDir, categories=None, mmapMode='r', checkSources=False):
+        """
+        Loads the frames of each category with a frame cube in
+        cubeDir, or of those named in categories, from the cube
+        written by exportFrameCubes, in place of loadFrames. The
+        frames are CubeFrame objects viewing the cube, and the
+        (N, H, W) cube itself is kept in frameCubes by category.
+        No FITS file is opened. With the default mmapMode of 'r'
+        the cube is memory mapped read only, so nothing is read
+        until it is used; see FrameCube.readFrameCube for
+        mmapMode and checkSources. The cube holds the data as
+        stored, i.e. unscaled for compact frames. Returns the
+        categories loaded.
+        """
+
+        loaded = []
+        for category, frameAttr, label in self._frameCategories(categories):
+            path = os.path.join(cubeDir, category)
+            if (categories is None) and (not os.path.exists(f"{path}.json")):
+                continue
+            with stage('load', f"{label} cube"):
+                try:
+                    cube, frames = readFrameCube(path, mmapMode=mmapMode, checkSources=checkSources)
+                except Exception as e:
+                    logger.error(f"Could not load the {label} frame cube from {cubeDir}: {e}")
+                    raise e
+            getattr(self, frameAttr)[:] = frames
+            self.frameCubes[category] = cube
+            loaded.append(category)
+            logger.info(f"Loaded {len(frames)} {label} frames from their frame cube.")
+        return loaded
+
+
+    def makeSuperBias(self, combineMethod='median', maxTileBytes=None, maxWorkers=1, outputDtype=None,
+            region=None, **combineOptions):
+        """
+        combineMethod is one of FrameCombine.COMBINE_METHODS,
+        and combineOptions are passed on to its reducer, e.g.
+        sigma and maxIters for 'sigmaclip'.
+
+        With maxTileBytes, the frames are combined a tile at a
+        time so no more than maxTileBytes of the frame stack is
+        in memory at once. The result is the same either way.
+        Methods other than 'median' are always tiled.
+
+        With maxWorkers > 1 (or None, for one per CPU), the
+        tiles are reduced by a process pool working on the
+        frames in shared memory. The result is again the same.
+
+        outputDtype is the dtype of the super frame's data, e.g.
+        np.float32. By default it is whatever the combine gives,
+        float64 for integer frames. Compact frames are stacked
+        in their own integer dtype, or in float32 when a
+        correction is subtracted; see loadFrames.
+
+        With region, only that part of the frames is combined,
+        e.g. region='BIASSEC' for the overscan. It is given as
+        for loadFrames, and must be inside the region the frames
+        were loaded with. The super frame records it. Corrections
+        are cut to it from super frames covering it.
+
+        If superFrameCache is set, a super frame made earlier
+        from the same files, method and corrections is loaded
+        from the cache instead of being combined again.
         """
 
         if self._listEmpty(self.biasFrames):
             logger.warning("Configured bias frame list is empty. Nothing to do!")
             raise ValueError("Configured bias frame list is empty. Nothing to do!")
         try:
-            self.superBiasFrame = SuperFrame(
-                    data=self._medianCombine(
-                        [f.data for f in self.biasFrames],
-                        axis=0
-                        ),
-                    combineMethod='median',
+            self.superBiasFrame = self._makeSuperFrame(
+                    self.biasFrames,
                     name='super bias',
+                    region=region,
+                    combineMethod=combineMethod,
+                    maxTileBytes=maxTileBytes,
+                    maxWorkers=maxWorkers,
+                    outputDtype=outputDtype,
+                    **combineOptions,
                     )
         except ValueError as e:
             logger.warn(f"Super bias not generated: {e}")
 
 
-    def makeSuperDark(self, biasSubtract=False):
+    def makeSuperDark(self, biasSubtract=False, combineMethod='median', maxTileBytes=None, maxWorkers=1,
+            outputDtype=None, region=None, **combineOptions):
         """
+        See makeSuperBias for combineMethod, maxTileBytes,
+        maxWorkers, outputDtype, region and combineOptions.
         """
         if self._listEmpty(self.darkFrames):
             logger.warning("Configured dark frame list is empty. Nothing to do!")
             raise ValueError("Configured dark frame list is empty. Nothing to do!")
         
-        if not biasSubtract:
-            try:
-                self.superDarkFrame = SuperFrame(
-                        data=self._medianCombine(
-                            [f.data for f in self.darkFrames], 
-                            axis=0
-                            ),
-                        biasSubtracted=biasSubtract,
-                        combineMethod='median',
-                        name='super dark',
-                        )
-            except ValueError as e:
-                logger.warn(f"Super dark not generated{e}")
-        else:
-            try:
-                self.superDarkFrame = SuperFrame(
-                        data=self._medianCombine(
-                            [f.data for f in self.darkFrames],
-                            correction=self.superBiasFrame.data,
-                            axis=0
-                            ),
-                        biasSubtracted=biasSubtract,
-                        combineMethod='median',
-                        name='super dark',
-                        )
-            except ValueError as e:
-                logger.warn(f"Super dark not generated: {e}")
+        try:
+            region, _ = self._frameRegion(self.darkFrames, region)
+            self.superDarkFrame = self._makeSuperFrame(
+                    self.darkFrames,
+                    name='super dark',
+                    region=region,
+                    correctionFrames=[self.superBiasFrame] if biasSubtract else [],
+                    correction=self._regionData(self.superBiasFrame, region) if biasSubtract else None,
+                    biasSubtracted=biasSubtract,
+                    combineMethod=combineMethod,
+                    maxTileBytes=maxTileBytes,
+                    maxWorkers=maxWorkers,
+                    outputDtype=outputDtype,
+                    **combineOptions,
+                    )
+        except ValueError as e:
+            logger.warn(f"Super dark not generated: {e}")
 
 
-    def makeBlueSuperFlat(self, biasSubtract=False, darkSubtract=False):
+    def makeBlueSuperFlat(self, biasSubtract=False, darkSubtract=False,
+            combineMethod='median', maxTileBytes=None, maxWorkers=1, outputDtype=None, region=None,
+            **combineOptions):
         """
+        See makeSuperBias for combineMethod, maxTileBytes,
+        maxWorkers, outputDtype, region and combineOptions.
         """
         try:
-            self.superBlueFlatFrame = SuperFrame(
-                    data=self._makeSuperFlat(
-                        self.blueFlatFrames,
-                        biasSubtract=biasSubtract,
-                        darkSubtract=darkSubtract
-                        ),
-                    biasSubtracted=biasSubtract,
-                    darkSubtracted=darkSubtract,
-                    combineMethod='median',
+            self.superBlueFlatFrame = self._makeSuperFlat(
+                    self.blueFlatFrames,
                     name='blue super flat',
+                    biasSubtract=biasSubtract,
+                    darkSubtract=darkSubtract,
+                    region=region,
+                    combineMethod=combineMethod,
+                    maxTileBytes=maxTileBytes,
+                    maxWorkers=maxWorkers,
+                    outputDtype=outputDtype,
+                    **combineOptions,
                     )
         except ValueError as e:
             logger.warn(f"Blue super flat not created: {e}")
 
 
-    def makeRedSuperFlat(self, biasSubtract=False, darkSubtract=False):
+    def makeRedSuperFlat(self, biasSubtract=False, darkSubtract=False,
+            combineMethod='median', maxTileBytes=None, maxWorkers=1, outputDtype=None, region=None,
+            **combineOptions):
         """
+        See makeSuperBias for combineMethod, maxTileBytes,
+        maxWorkers, outputDtype, region and combineOptions.
         """
         try:
-            self.superRedFlatFrame = SuperFrame(
-                    data=self._makeSuperFlat(
-                        self.redFlatFrames,
-                        biasSubtract=biasSubtract,
-                        darkSubtract=darkSubtract
-                        ),
-                    biasSubtracted=biasSubtract,
-                    darkSubtracted=darkSubtract,
-                    combineMethod='median',
-                    name='red super flat'
+            self.superRedFlatFrame = self._makeSuperFlat(
+                    self.redFlatFrames,
+                    name='red super flat',
+                    biasSubtract=biasSubtract,
+                    darkSubtract=darkSubtract,
+                    region=region,
+                    combineMethod=combineMethod,
+                    maxTileBytes=maxTileBytes,
+                    maxWorkers=maxWorkers,
+                    outputDtype=outputDtype,
+                    **combineOptions,
                     )
         except ValueError as e:
             logger.warn(f"Red super flat not generated: {e}")
     
 
-    def _makeSuperFlat(self, frames, biasSubtract=False, darkSubtract=False):
+    def calibrateFrames(self, outputDir, calibrateObjectFrames=True, calibrateWaveCalFrames=True,
+            biasSubtract=True, darkSubtract=False, flatField=None, suffix='_cal',
+            outputDtype=np.float32, overwrite=False):
+        """
+        Streams the configured object and wave cal files through
+        bias, dark and flat correction one at a time, writing
+        each calibrated frame to outputDir with suffix added to
+        its name. Returns the list of files written.
+
+        The super frames must be made beforehand. flatField is
+        None, 'blue' or 'red', picking the super flat to divide
+        by; it is normalized to a median of 1 first. If the
+        super dark was not bias subtracted, it already holds the
+        bias, so only the dark is subtracted.
+
+        A bias subtracted super dark is scaled to each frame's
+        EXPTIME. One that still holds the bias can't be, so a
+        frame with another exposure time raises ValueError.
+        Frames or super darks with no EXPTIME get the super dark
+        unscaled, with a warning. HISTORY records which.
+
+        The next file is read and the previous result written
+        by background threads while the current one is
+        corrected, so only a few frames are in memory at once.
+        """
+
+        fileList = []
+        if calibrateObjectFrames:
+            fileList += self.echelleDataSequenceConfiguration.objectList
+        if calibrateWaveCalFrames:
+            fileList += self.echelleDataSequenceConfiguration.waveCalList
+        if self._listEmpty(fileList):
+            logger.warning("Configured object and wave cal lists are empty. Nothing to do!")
+            raise ValueError("Configured object and wave cal lists are empty. Nothing to do!")
+
+        bias, dark, flat, history = self._calibrationFrames(biasSubtract, darkSubtract, flatField)
+        os.makedirs(outputDir, exist_ok=True)
+
+        ## The correction for each dark scale met so far; frames share a few exposure times.
+        corrections = {}
+
+        written = []
+        with stage('calibrate', outputDir), ThreadPoolExecutor(max_workers=2) as io:
+            nextRead = io.submit(_readFrameData, fileList[0])
+            pendingWrite = None
+            for num, file in enumerate(fileList):
+                try:
+                    header, data = nextRead.result()
+                except Exception as e:
+                    logger.error(f"An error occurred while attempting to open a FITS file: {e}")
+                    raise e
+                if num + 1 < len(fileList):
+                    nextRead = io.submit(_readFrameData, fileList[num + 1])
+
+                logger.debug(f"Calibrating: {header.get('IMAGETYP')} frame: {file}")
+                addToStage(bytesRead=headerBytes(header) + data.nbytes, frames=1)
+                scale, darkHistory = self._darkScale(header, file, darkSubtract)
+                if scale not in corrections:
+                    corrections[scale] = _scaledCorrection(bias, dark, scale)
+                correction = corrections[scale]
+                calibrated = np.asarray(data, dtype=np.float64)
+                if correction is not None:
+                    calibrated = calibrated - correction
+                if flat is not None:
+                    calibrated /= flat
+                calibrated = calibrated.astype(outputDtype, copy=False)
+
+                header = header.copy()
+                for card in ('BZERO', 'BSCALE', 'BLANK'):
+                    header.remove(card, ignore_missing=True)
+                header['BIASSUB'] = (bool(biasSubtract), 'Bias subtracted')
+                header['DARKSUB'] = (bool(darkSubtract), 'Dark subtracted')
+                header['FLATCORR'] = (flatField or '', 'Super flat divided')
+                for line in history + darkHistory:
+                    header.add_history(line)
+
+                outFile = os.path.join(outputDir, _calibratedFileName(file, suffix))
+                if pendingWrite is not None:
+                    pendingWrite.result()
+                pendingWrite = io.submit(_writeFrame, outFile, calibrated, header, overwrite)
+                written.append(outFile)
+                del data, calibrated
+
+            if pendingWrite is not None:
+                pendingWrite.result()
+
+        logger.info(f"Wrote {len(written)} calibrated frames to {outputDir}")
+        return written
+
+
+    def _calibrationFrames(self, biasSubtract=True, darkSubtract=False, flatField=None):
+        """
+        Returns the correction subtracted from every frame, the
+        bias subtracted super dark to scale to each frame's
+        exposure time, the normalized flat to divide by (any of
+        them may be None), and the HISTORY lines describing them.
+        A super dark that still holds the bias is returned as
+        the first, since it can't be scaled.
+        """
+
+        bias = None
+        dark = None
+        history = []
+        if darkSubtract:
+            self._checkWholeDetector(self.superDarkFrame, *([self.superBiasFrame] if biasSubtract else []))
+            if self.superDarkFrame.biasSubtracted:
+                dark = self.superDarkFrame.data
+                if biasSubtract:
+                    bias = self.superBiasFrame.data
+                    history.append("Subtracted super bias.")
+            else:
+                bias = self.superDarkFrame.data
+                if biasSubtract:
+                    logger.info("Super dark was not bias subtracted, so it already removes the bias.")
+            history.append("Subtracted super dark.")
+        elif biasSubtract:
+            self._checkWholeDetector(self.superBiasFrame)
+            bias = self.superBiasFrame.data
+            history.append("Subtracted super bias.")
+
+        flat = None
+        if flatField is not None:
+            match flatField.lower():
+                case 'blue':
+                    superFlat = self.superBlueFlatFrame
+                case 'red':
+                    superFlat = self.superRedFlatFrame
+                case _:
+                    raise ValueError(f"flatField must be None, 'blue' or 'red', not {flatField!r}")
+            self._checkWholeDetector(superFlat)
+            flat = superFlat.data / np.median(superFlat.data)
+            history.append(f"Divided by normalized {superFlat.name}.")
+
+        return bias, dark, flat, history
+
+
+    def _darkScale(self, header, file, darkSubtract=False):
+        """
+        Returns the factor scaling the super dark to the
+        exposure time of the frame with header, and the HISTORY
+        lines saying so.
+        """
+
+        if not darkSubtract:
+            return 1.0, []
+        darkExposure = self.superDarkFrame.exposureTime
+        exposure = header.get('EXPTIME')
+        if (darkExposure is None) or (darkExposure <= 0) or (not isinstance(exposure, (int, float))):
+            logger.warning(f"No exposure time for {file} or the super dark. Subtracting the super dark unscaled.")
+            return 1.0, ["Super dark not scaled: exposure time unknown."]
+        if exposure == darkExposure:
+            return 1.0, []
+        if not self.superDarkFrame.biasSubtracted:
+            logger.error(f"{file} has EXPTIME {exposure}, but the super dark, which still holds the bias, "
+                    f"has {darkExposure}.")
+            raise ValueError(f"Can't scale a super dark that isn't bias subtracted to the EXPTIME of {file}. "
+                    "Make it with biasSubtract=True.")
+        return exposure/darkExposure, [f"Scaled super dark by EXPTIME {exposure:g}/{darkExposure:g}."]
+
+
+    def _checkWholeDetector(self, *superFrames):
+        """
+        Raises ValueError if a super frame only covers a region.
+        """
+        for superFrame in superFrames:
+            if superFrame.region is not None:
+                raise ValueError(f"{superFrame.name} only covers {regionSection(superFrame.region)}. "
+                        "Calibration needs super frames of the whole detector.")
+
+
+    def _makeSuperFlat(self, frames, name=None, biasSubtract=False, darkSubtract=False, region=None,
+            combineMethod='median', maxTileBytes=None, maxWorkers=1, outputDtype=None, **combineOptions):
         """
         """
         if self._listEmpty(frames):
             logger.warning("Configured flat frame list is empty. Nothing to do!")
             raise ValueError("Configured flat frame list is empty. Nothing to do!")
         
-        if (not biasSubtract) and (not darkSubtract):
-            try:
-                return self._medianCombine(
-                    [f['data'] for f in frames], 
-                    axis=0
+        region, _ = self._frameRegion(frames, region)
+        correction = None
+        correctionFrames = []
+        if biasSubtract and (not darkSubtract):
+            correction = self._regionData(self.superBiasFrame, region)
+            correctionFrames = [self.superBiasFrame]
+        if (not biasSubtract) and darkSubtract:
+            correction = self._regionData(self.superDarkFrame, region)
+            correctionFrames = [self.superDarkFrame]
+        if biasSubtract and darkSubtract:
+            ## Subtract the bias from the flat. Does not know if the Dark
+            ## frame has been dark-subtracted. Careful!
+            correction = self._regionData(self.superDarkFrame, region) - self._regionData(self.superBiasFrame, region)
+            correctionFrames = [self.superDarkFrame, self.superBiasFrame]
+
+        return self._makeSuperFrame(
+            frames,
+            name=name,
+            region=region,
+            correction=correction,
+            correctionFrames=correctionFrames,
+            biasSubtracted=biasSubtract,
+            darkSubtracted=darkSubtract,
+            combineMethod=combineMethod,
+            maxTileBytes=maxTileBytes,
+            maxWorkers=maxWorkers,
+            outputDtype=outputDtype,
+            **combineOptions,
+            )
+
+
+    def _makeCategorySuperFrame(self, category, frames, name, biasSubtract=False, darkSubtract=False, region=None,
+            **options):
+        """
+        Combines frames of category with the corrections the
+        make* method of the category would apply.
+        """
+        if category in ('blueFlat', 'redFlat'):
+            return self._makeSuperFlat(frames, name=name, biasSubtract=biasSubtract, darkSubtract=darkSubtract,
+                    region=region, **options)
+        if darkSubtract:
+            raise ValueError("Only flats can be dark subtracted.")
+        if biasSubtract and (category == 'bias'):
+            raise ValueError("Bias frames can't be bias subtracted.")
+
+        region, _ = self._frameRegion(frames, region)
+        return self._makeSuperFrame(
+                frames,
+                name=name,
+                region=region,
+                correctionFrames=[self.superBiasFrame] if biasSubtract else [],
+                correction=self._regionData(self.superBiasFrame, region) if biasSubtract else None,
+                biasSubtracted=None if category == 'bias' else biasSubtract,
+                **options,
+                )
+
+
+    def _makeSuperFrame(self, frames, name=None, correction=None, correctionFrames=(),
+            biasSubtracted=None, darkSubtracted=None, combineMethod='median',
+            maxTileBytes=None, maxWorkers=1, outputDtype=None, region=None, **combineOptions):
+        """
+        Combines frames into a SuperFrame, going through
+        superFrameCache when it is set. correctionFrames are
+        the super frames correction was made from, which are
+        part of the cache key. correction must already cover
+        region. Frames rejected by rejectFrames are left out.
+        """
+        accepted = self._acceptedFrames(frames)
+        if len(accepted) < len(frames):
+            logger.info(f"Leaving {len(frames) - len(accepted)} rejected frames out of the {name}.")
+        if self._listEmpty(accepted):
+            raise ValueError(f"Every frame of the {name} has been rejected.")
+        frames = accepted
+
+        with stage('combine', name, frames=len(frames)):
+            region, window = self._frameRegion(frames, region)
+            if region == resolveRegion(None, self._detectorShape(frames)):
+                region = None
+
+            dtype = None
+            if any(getattr(f, 'isCompact', False) for f in frames):
+                dtype = compactStackDtype(frames, correction)
+            outputDtype = np.dtype(outputDtype).name if outputDtype is not None else None
+
+            key = None
+            if self.superFrameCache is not None:
+                key = self.superFrameCache.makeKey(
+                        frames,
+                        name=name,
+                        combineMethod=combineMethod,
+                        combineOptions=combineOptions,
+                        biasSubtracted=biasSubtracted,
+                        darkSubtracted=darkSubtracted,
+                        correctionFrames=correctionFrames,
+                        stackDtype=dtype,
+                        outputDtype=outputDtype,
+                        region=region,
+                        )
+                cached = self.superFrameCache.load(key) if key else None
+                if cached is not None:
+                    logger.info(f"Loaded {name} from the super frame cache.")
+                    return cached
+
+            superFrame = SuperFrame(
+                    data=self._combine(
+                        frames,
+                        combineMethod=combineMethod,
+                        correction=correction,
+                        maxTileBytes=maxTileBytes,
+                        maxWorkers=maxWorkers,
+                        dtype=dtype,
+                        outputDtype=outputDtype,
+                        window=window,
+                        **combineOptions,
+                        ),
+                    biasSubtracted=biasSubtracted,
+                    darkSubtracted=darkSubtracted,
+                    combineMethod=combineMethod,
+                    combineOptions=combineOptions,
+                    outputDtype=outputDtype,
+                    region=region,
+                    name=name,
+                    exposureTime=_exposureTime(frames),
+                    provenance=key,
                     )
-            except ValueError as e:
-                raise e
-        else:
-            if biasSubtract and (not darkSubtract):
-                correction = self.superBiasFrame.data
-            if (not biasSubtract) and darkSubtract:
-                correction = self.superDarkFrame.data
-            if biasSubtract and darkSubtract:
-                ## Subtract the bias from the flat. Does not know if the Dark
-                ## frame has been dark-subtracted. Careful!
-                correction = self.superDarkFrame.data - self.superBiasFrame.data
-            try:
-                return self._medianCombine(
-                    [f.data for f in frames],
+            if key:
+                self.superFrameCache.store(key, superFrame)
+            return superFrame
+
+
+    def _combine(self, frames, combineMethod='median', correction=None, maxTileBytes=None,
+            maxWorkers=1, dtype=None, outputDtype=None, window=None, **combineOptions):
+        """
+        Combines frames with the named combine method, stacking
+        them as dtype if given. window is the (rows, cols) slices
+        of the frames' data to combine. A serial median of
+        frames in their own dtype goes through _medianCombine,
+        so it keeps the untiled path when maxTileBytes is None.
+        """
+        parallel = (maxWorkers is None) or (maxWorkers > 1)
+        if combineMethod == 'median' and (not combineOptions) and (not parallel) and (dtype is None):
+            combined = self._medianCombine(frames, correction=correction, axis=0, maxTileBytes=maxTileBytes,
+                    window=window)
+            return combined if outputDtype is None else combined.astype(outputDtype, copy=False)
+
+        if self._listEmpty(frames):
+            logger.error("Frames list is empty.")
+            raise ValueError("Empty list passed to _combine")
+
+        reducer, workBytes = getReducer(combineMethod, **combineOptions)
+        if parallel:
+            return combineParallel(
+                    frames,
+                    reducer,
                     correction=correction,
-                    axis=0
+                    maxTileBytes=maxTileBytes or DEFAULT_MAX_TILE_BYTES,
+                    workBytes=workBytes,
+                    maxWorkers=maxWorkers,
+                    dtype=dtype,
+                    outputDtype=outputDtype,
+                    window=window,
                     )
-            except ValueError as e:
-                raise e
+        return combineTiled(
+                frames,
+                reducer,
+                correction=correction,
+                maxTileBytes=maxTileBytes or DEFAULT_MAX_TILE_BYTES,
+                workBytes=workBytes,
+                dtype=dtype,
+                outputDtype=outputDtype,
+                window=window,
+                )
 
 
-    def _medianCombine(self, frames, correction=None, axis=0):
+    def _medianCombine(self, frames, correction=None, axis=0, maxTileBytes=None, window=None):
         """
+        frames may be Frame objects or arrays. With maxTileBytes,
+        the median is taken tile by tile over axis 0 by
+        FrameCombine.combineTiled, instead of over one stack of
+        every frame. window, if given, is the (rows, cols) slices
+        of the frames to take the median of.
         """
         if self._listEmpty(frames):
             logger.error("Frames list is empty.")
             raise ValueError("Empty list passed to _medianCombine")
 
-        if correction is None:
-            return np.median(frames, axis=axis)
-        elif isinstance(correction, np.ndarray):
-            return np.median([f - correction for f in frames], axis=axis)
-        else:
+        if (correction is not None) and (not isinstance(correction, np.ndarray)):
             logger.error("kwarg correction must be None or numpy.ndarray")
             raise ValueError("kwarg correction must be None or numpy.ndarray")
 
+        if maxTileBytes is not None:
+            if axis != 0:
+                raise ValueError("Tiled combine only supports axis=0")
+            return combineTiled(frames, medianReducer, correction=correction, maxTileBytes=maxTileBytes,
+                    window=window)
+
+        data = [frameData(f) if window is None else frameData(f)[window] for f in frames]
+        if correction is None:
+            return np.median(data, axis=axis)
+        else:
+            return np.median([d - correction for d in data], axis=axis)
+
 
-    def _loadFrames(self, fileList, frameList, frameType=None):
+    def _loadFrames(self, fileList, frameList, frameType=None, lazy=False, pending=None, compact=False, region=None):
         """
+        pending, if given, holds futures of _readFrame for
+        each file in fileList, submitted by loadFrames.
         """
 
         if self._listEmpty(fileList):
@@ -263,12 +1056,78 @@ class EchelleDataSequence:
 
         for num, file in enumerate(fileList):
             try:
-                with fits.open(file) as hdul:
-                    logger.info(f"Loading: {hdul[0].header['IMAGETYP']} filter: {hdul[0].header['FILTER']} frame: {file}")
-                    frameList.append( Frame(data=hdul[0].data, header=hdul[0].header, name=f"{frameType} {num+1:n}"))
+                header, data, hduIndex, compressed, frameRegion = \
+                        pending[num].result() if pending else _readFrame(file, lazy, compact, region)
+                logger.debug(f"Loading: {header['IMAGETYP']} filter: {header['FILTER']} frame: {file}")
+                addToStage(bytesRead=headerBytes(header) + (0 if data is None else data.nbytes), frames=1)
+                scale = {'bzero' : header.get('BZERO', 0), 'bscale' : header.get('BSCALE', 1)} if compact else {}
+                if lazy:
+                    frameList.append( LazyFrame(header=header, fileName=file, hduIndex=hduIndex, compressed=compressed,
+                        region=frameRegion, residencyPool=self.residencyPool, name=f"{frameType} {num+1:n}", **scale))
+                else:
+                    frameList.append( Frame(data=data, header=header, fileName=file, hduIndex=hduIndex,
+                        region=frameRegion, name=f"{frameType} {num+1:n}", **scale))
             except Exception as e:
                 logger.error(e)
                 raise e
+        logger.info(f"Loaded {len(fileList)} {frameType} frames.")
+
+
+    def _acceptedFrames(self, frames):
+        """
+        Returns frames, without those rejected in frameQA.
+        """
+        if (self.frameQA is None) or (not self.frameQA.rejected.any()):
+            return frames
+        rejected = {id(f) for f, r in zip(self.frameQA.frames, self.frameQA.rejected) if r}
+        return [f for f in frames if id(f) not in rejected]
+
+
+    def _frameCategories(self, categories=None):
+        """
+        Returns the FRAME_CATEGORIES entries named in categories,
+        or all of them.
+        """
+        if categories is None:
+            return FRAME_CATEGORIES
+        known = {c[0] : c for c in FRAME_CATEGORIES}
+        unknown = [c for c in categories if c not in known]
+        if unknown:
+            raise ValueError(f"Unknown frame categories {unknown}. Choose from {list(known)}.")
+        return [known[c] for c in categories]
+
+
+    def _frameRegion(self, frames, region=None):
+        """
+        Returns the detector region to combine frames over,
+        resolved, and the slices of the frames' data covering
+        it. region defaults to the region the frames hold,
+        which must be the same for all of them.
+        """
+        loaded = frames[0].region
+        if any(f.region != loaded for f in frames):
+            raise ValueError("Frames cover different regions of the detector.")
+        if region is None:
+            region = loaded
+        else:
+            region = parseRegion(region, frames[0].header)
+        region = resolveRegion(region, self._detectorShape(frames))
+        return region, subRegion(region, loaded)
+
+
+    def _detectorShape(self, frames):
+        """
+        """
+        header = frames[0].header
+        return (header['NAXIS2'], header['NAXIS1'])
+
+
+    def _regionData(self, superFrame, region):
+        """
+        Returns the data of superFrame over region, which must be
+        inside the region superFrame covers.
+        """
+        return superFrame.data[subRegion(region, superFrame.region)]
 
 
     def _listEmpty(self, theList):
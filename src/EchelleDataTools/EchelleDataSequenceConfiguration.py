@@ -3,16 +3,144 @@
 __all__ = ['EchelleDataSequenceConfiguration']
 
 
+from .HeaderIndex import HeaderIndex
+from .Instrumentation import addToStage, headerBytes, stage
+
 import astropy.io.fits as fits
+import bz2
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import partial
+import gzip
+import hashlib
+import json
 import logging
 import os
 import glob
+import tempfile
 
 
 logger = logging.getLogger(f"{__name__}")
 
 
+## Header cards needed to classify a frame.
+CLASSIFICATION_CARDS = ('IMAGETYP', 'FILTER')
+
+## Header cards read during a scan, recorded in the manifest and indexed, by default.
+HEADER_CARDS = CLASSIFICATION_CARDS + ('EXPTIME', 'DATE-OBS', 'CCDTEMP')
+
+## Name of the manifest file written beside the data, and its format version.
+MANIFEST_NAME = '.echelle_manifest.json'
+MANIFEST_VERSION = 1
+
+## Openers for the compressed file extensions astropy reads transparently.
+_COMPRESSED_OPENERS = {
+        '.gz' : gzip.open,
+        '.bz2' : bz2.open,
+        }
+
+
+def _imageHDUIndex(hdul):
+    """
+    Returns the index of the HDU in hdul holding the frame.
+    That is the primary HDU, unless it has no data and is
+    followed by a tile compressed image, as in the .fits.fz
+    files written by fpack, in which case it is the first
+    CompImageHDU. Returns None if hdul[0] is not a PrimaryHDU.
+    """
+
+    if not isinstance(hdul[0], fits.PrimaryHDU):
+        return None
+    if hdul[0].header.get('NAXIS', 0) == 0:
+        for index, hdu in enumerate(hdul[1:], start=1):
+            if isinstance(hdu, fits.CompImageHDU):
+                return index
+    return 0
+
+
+def _readImageHeader(fitsFile, headerOnly=False):
+    """
+    Returns the header of the frame in fitsFile (see
+    _imageHDUIndex), and whether the file starts with a
+    PrimaryHDU. With headerOnly, only the header blocks at
+    the start of the file are read instead of going through
+    fits.open. A compressed image must then directly follow
+    an empty primary HDU, and its cards are read from the
+    binary table header it is stored in.
+    """
+
+    if not headerOnly:
+        with fits.open(fitsFile) as hdul:
+            index = _imageHDUIndex(hdul)
+            if index is None:
+                return hdul[0].header, False
+            return hdul[index].header, True
+
+    opener = _COMPRESSED_OPENERS.get(os.path.splitext(fitsFile)[1].lower(), open)
+    with opener(fitsFile, 'rb') as f:
+        header = fits.Header.fromfile(f)
+        isPrimary = (
+                len(header) > 0
+                and header.cards[0].keyword == 'SIMPLE'
+                and header['SIMPLE'] is True
+                )
+        ## With no primary data, the next header starts right after this one.
+        if isPrimary and (header.get('NAXIS', 0) == 0) and header.get('EXTEND', False):
+            try:
+                extension = fits.Header.fromfile(f)
+            except Exception:
+                extension = None
+            if (extension is not None) and (extension.get('ZIMAGE') is True):
+                header = extension
+    return header, isPrimary
+
+
+def _readClassificationCards(fitsFile, headerOnly=False, cards=HEADER_CARDS):
+    """
+    Reads the requested cards from the header of the frame
+    in fitsFile, which for a .fits.fz file is the header of
+    the compressed image. Returns a tuple (values, error,
+    nbytes). values is a dict of the cards found in the
+    header, or None if the file can't be used. error is None,
+    or a (level, message) tuple to be logged by the caller.
+    Messages are returned rather than logged so that files
+    read by a pool of workers are still reported in fitsList
+    order. nbytes is the size of the header read.
+    """
+
+    try:
+        header, isPrimary = _readImageHeader(fitsFile, headerOnly=headerOnly)
+    except Exception as e:
+        return None, (logging.ERROR, f"opening {fitsFile=} raise an exception {e=}. Skipping..."), 0
+
+    if not isPrimary:
+        return None, (logging.WARNING, f"HDU from {fitsFile=} doesn't contain a PimaryHDU object. Skipping."), \
+                headerBytes(header)
+
+    return {card : _jsonCardValue(header[card]) for card in cards if card in header}, None, headerBytes(header)
+
+
+def _jsonCardValue(value):
+    """
+    Header values are str, int, float or bool, except for
+    blank cards. Those are stored as None so the values
+    can always be written to the manifest.
+    """
+
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return None
+
+
+def _userCacheDir():
+    """
+    Returns the per-user cache directory for EchelleDataTools.
+    """
+
+    cacheHome = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheHome, 'EchelleDataTools')
+
+
 @dataclass
 class EchelleDataSequenceConfiguration:
     dataRoot : str
@@ -30,6 +158,13 @@ class EchelleDataSequenceConfiguration:
     numRedFlat : int = 0
     numWaveCal : int = 0
     numObject : int = 0
+    headerOnly : bool = field(default=False, repr=False)
+    maxWorkers : int = field(default=1, repr=False)
+    useProcessPool : bool = field(default=False, repr=False)
+    useManifest : bool = field(default=False, repr=False)
+    manifestPath : str = field(default=None, repr=False)
+    headerCards : tuple = field(default=HEADER_CARDS, repr=False)
+    headerIndex : HeaderIndex = field(default=None, init=False, repr=False)
 
     def __post_init__(self):#, *args, **kwargs):
         """
@@ -38,18 +173,19 @@ class EchelleDataSequenceConfiguration:
         construct the needed frame lists.
         """
 
-        try:
-            self._isDataRootExist()
-            self._isValidDataInDataRoot()
-        except NotADirectoryError as e:
-            raise e
-        except FileNotFoundError as e:
-            raise e
+        with stage('scan', self.dataRoot):
+            try:
+                self._isDataRootExist()
+                self._isValidDataInDataRoot()
+            except NotADirectoryError as e:
+                raise e
+            except FileNotFoundError as e:
+                raise e
 
-        try:
-            self._makeFrameLists()
-        except Exception as e:
-            logger.error(e)
+            try:
+                self._makeFrameLists()
+            except Exception as e:
+                logger.error(e)
     
     
     def _isDataRootExist(self):
@@ -101,53 +237,22 @@ class EchelleDataSequenceConfiguration:
         malformed, is missing a needed header
         card, or has unknown values for the
         aforementioned cards.
+
+        Every file read, classified or not, gets a row of its
+        headerCards in headerIndex.
         """
 
-        ## Step through files in fitsList and try opening, raise exception on failure.
-        for fitsFile in self.fitsList:
-            try:
-                with fits.open(fitsFile) as hdu:
-                    pass
-            except Exception as e:
-                logger.error(f"opening {fitsFile=} raise an exception {e=}. Skipping...")
+        ## Read the classification cards of every file, then classify in fitsList order.
+        fileNames, categories, cardValues = [], [], []
+        for fitsFile, (cards, error) in zip(self.fitsList, self._readFitsCards()):
+            if error is not None:
+                logger.log(*error)
                 continue
-            else:
-                if not isinstance(hdu[0], fits.PrimaryHDU):
-                    logger.warn(f"HDU from {fitsFile=} doesn't contain a PimaryHDU object. Skipping.")
-                    continue
-                
-                ## Get image type and filter type from FITS header
-                try:
-                    imageTyp = hdu[0].header['IMAGETYP']
-                except KeyError as e:
-                    logger.warn(f"HDU from {fitsFile=} does not contain 'IMAGETYP' card. Skipping.")
-                    continue
-                try:
-                    filterType = hdu[0].header['FILTER']
-                except KeyError as e:
-                    logger.warn(f"HDU from {fitsFile=} does not contain 'FILTER' card. Skipping")
-                    continue
-
-                ## Put the images in their appropriate lists.
-                match imageTyp.upper():
-                    case "ZERO":    #Bias frame
-                        self.biasList.append(fitsFile)
-                    case "FLAT":    #flat frame
-                        if filterType.upper() == 'BLUE':
-                            self.blueFlatList.append(fitsFile)
-                        elif filterType.upper() == 'OPEN':
-                            self.redFlatList.append(fitsFile)
-                        else:
-                            loger.warn(f"HDU from {fitsFile=} contains unknown value from card 'FILTER': {filterType}")
-                    case "DARK":    #dark frame
-                        self.darkList.append(fitsFile)
-                    case "OBJECT":  #object frame
-                        self.objectList.append(fitsFile)
-                    case "COMP":    #Wavecal frame
-                        self.waveCalList.append(fitsFile)
-                    case _:         #default
-                        logger.warn(f"HDU from {fitsFile=} contains unknown 'IMAGETYP' {imageType}")
-        
+            fileNames.append(fitsFile)
+            categories.append(self._classifyFrame(fitsFile, cards))
+            cardValues.append(cards)
+        self.headerIndex = HeaderIndex.fromCards(fileNames, categories, cardValues, self._scanCards())
+
         self.numFits = len(self.fitsList)
         logger.info(f"Found FITS files frames: {self.numFits}")
         self.numBias = len(self.biasList)
@@ -163,3 +268,199 @@ class EchelleDataSequenceConfiguration:
         self.numObject = len(self.objectList)
         logger.info(f"Found object: {self.numObject}")
 
+
+
+    def _readFitsCards(self):
+        """
+        Reads the header cards of each file in fitsList,
+        returning (cards, error) tuples in fitsList order.
+        With useManifest, only files that are new or whose
+        size or mtime changed since the last scan are read.
+        """
+
+        if not self.useManifest:
+            return self._readFitsFiles(self.fitsList)
+
+        manifestPath = self.manifestPath or self._defaultManifestPath()
+        entries = self._loadManifest(manifestPath)
+
+        stats = {}
+        for fitsFile in self.fitsList:
+            try:
+                st = os.stat(fitsFile)
+            except OSError:
+                continue
+            stats[fitsFile] = {'size' : st.st_size, 'mtime_ns' : st.st_mtime_ns}
+
+        ## Entries are keyed by file name, so the manifest doesn't depend on how dataRoot was spelled.
+        stale = []
+        for fitsFile in self.fitsList:
+            entry = entries.get(os.path.basename(fitsFile))
+            if (entry is None) or (fitsFile not in stats) \
+                    or (entry['size'] != stats[fitsFile]['size']) \
+                    or (entry['mtime_ns'] != stats[fitsFile]['mtime_ns']):
+                stale.append(fitsFile)
+        logger.info(f"Manifest {manifestPath} is current for {len(self.fitsList)-len(stale)} of {len(self.fitsList)} files.")
+
+        fresh = dict(zip(stale, self._readFitsFiles(stale)))
+
+        ## Rebuild the manifest from the current files only, which drops removed files.
+        ## Unreadable files are not recorded, so they are retried (and reported) on every scan.
+        results = []
+        newEntries = {}
+        for fitsFile in self.fitsList:
+            if fitsFile in fresh:
+                cards, error = fresh[fitsFile]
+                if (error is None) and (fitsFile in stats):
+                    newEntries[os.path.basename(fitsFile)] = dict(stats[fitsFile], cards=cards)
+            else:
+                entry = entries[os.path.basename(fitsFile)]
+                cards, error = entry['cards'], None
+                newEntries[os.path.basename(fitsFile)] = entry
+            results.append((cards, error))
+
+        if stale or (len(newEntries) != len(entries)):
+            self._writeManifest(manifestPath, newEntries)
+
+        return results
+
+
+    def _readFitsFiles(self, fitsFiles):
+        """
+        Reads the header cards of each file in fitsFiles.
+        With maxWorkers > 1 the files are spread over a
+        thread pool, or a process pool if useProcessPool
+        is set. (cards, error) tuples are returned in
+        fitsFiles order either way.
+        """
+
+        reader = partial(_readClassificationCards, headerOnly=self.headerOnly, cards=self._scanCards())
+
+        if ((self.maxWorkers is not None) and (self.maxWorkers <= 1)) or (len(fitsFiles) <= 1):
+            results = [reader(fitsFile) for fitsFile in fitsFiles]
+        else:
+            executorType = ProcessPoolExecutor if self.useProcessPool else ThreadPoolExecutor
+            with executorType(max_workers=self.maxWorkers) as executor:
+                results = list(executor.map(reader, fitsFiles))
+
+        addToStage(bytesRead=sum(nbytes for _, _, nbytes in results), frames=len(results))
+        return [(cards, error) for cards, error, _ in results]
+
+
+    def _scanCards(self):
+        """
+        The cards read from each file: those needed to classify
+        it, then headerCards.
+        """
+
+        return tuple(dict.fromkeys(CLASSIFICATION_CARDS + tuple(self.headerCards)))
+
+
+    def _defaultManifestPath(self):
+        """
+        The manifest goes beside the data when dataRoot is
+        writable, and in the user cache directory otherwise.
+        """
+
+        if os.access(self.dataRoot, os.W_OK):
+            return os.path.join(self.dataRoot, MANIFEST_NAME)
+
+        key = hashlib.sha1(os.path.abspath(self.dataRoot).encode()).hexdigest()
+        return os.path.join(_userCacheDir(), 'manifests', f"{key}.json")
+
+
+    def _loadManifest(self, manifestPath):
+        """
+        Returns the manifest entries stored at manifestPath.
+        A missing, unreadable or out-of-date manifest gives
+        no entries, so every file is read again.
+        """
+
+        try:
+            with open(manifestPath, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Could not read manifest {manifestPath}: {e}. Rescanning all files.")
+            return {}
+
+        if (manifest.get('version') != MANIFEST_VERSION) \
+                or (not set(self._scanCards()).issubset(manifest.get('cards', []))):
+            logger.info(f"Manifest {manifestPath} is out of date. Rescanning all files.")
+            return {}
+        return manifest.get('files', {})
+
+
+    def _writeManifest(self, manifestPath, entries):
+        """
+        Atomically replaces the manifest at manifestPath.
+        Failing to write it is not fatal to the scan.
+        """
+
+        manifest = {
+                'version' : MANIFEST_VERSION,
+                'cards' : list(self._scanCards()),
+                'files' : entries,
+                }
+        tmpPath = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(manifestPath)), exist_ok=True)
+            fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifestPath)), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmpPath, manifestPath)
+        except Exception as e:
+            logger.warning(f"Could not write manifest {manifestPath}: {e}")
+            if (tmpPath is not None) and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        else:
+            logger.debug(f"Wrote manifest {manifestPath} with {len(entries)} files.")
+
+
+    def _classifyFrame(self, fitsFile, cards):
+        """
+        Puts fitsFile in its appropriate list, based on
+        the 'IMAGETYP' and 'FILTER' values in cards, and
+        returns the name of its category (see
+        EchelleDataSequence.FRAME_CATEGORIES), or None.
+        """
+
+        ## Get image type and filter type from FITS header
+        try:
+            imageTyp = cards['IMAGETYP']
+        except KeyError as e:
+            logger.warn(f"HDU from {fitsFile=} does not contain 'IMAGETYP' card. Skipping.")
+            return None
+        try:
+            filterType = cards['FILTER']
+        except KeyError as e:
+            logger.warn(f"HDU from {fitsFile=} does not contain 'FILTER' card. Skipping")
+            return None
+
+        ## Put the images in their appropriate lists.
+        match imageTyp.upper():
+            case "ZERO":    #Bias frame
+                self.biasList.append(fitsFile)
+                return 'bias'
+            case "FLAT":    #flat frame
+                if filterType.upper() == 'BLUE':
+                    self.blueFlatList.append(fitsFile)
+                    return 'blueFlat'
+                elif filterType.upper() == 'OPEN':
+                    self.redFlatList.append(fitsFile)
+                    return 'redFlat'
+                else:
+                    logger.warn(f"HDU from {fitsFile=} contains unknown value from card 'FILTER': {filterType}")
+            case "DARK":    #dark frame
+                self.darkList.append(fitsFile)
+                return 'dark'
+            case "OBJECT":  #object frame
+                self.objectList.append(fitsFile)
+                return 'object'
+            case "COMP":    #Wavecal frame
+                self.waveCalList.append(fitsFile)
+                return 'waveCal'
+            case _:         #default
+                logger.warn(f"HDU from {fitsFile=} contains unknown 'IMAGETYP' {imageTyp}")
+        return None
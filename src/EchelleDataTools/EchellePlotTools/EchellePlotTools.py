@@ -1,40 +1,220 @@
 #!/usr/env/bin python3
 
-__all__ = ['plotImageAndHist', 'plotImageAndHistMulti']
+__all__ = ['plotImageAndHist', 'plotImageAndHistMulti', 'plotImageMulti', 'plotHistMulti', 'histogramCounts',
+        'PlotJob', 'renderPlotJobs']
 
 
 from astropy.visualization import HistEqStretch, ImageNormalize, hist
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import gc
+import logging
+import matplotlib
 import matplotlib.pyplot as plt
 import math
+from multiprocessing import shared_memory
 import numpy as np
+import sys
+import weakref
 
 from EchelleDataTools.Frame import *
+from EchelleDataTools.FrameCombine import frameData, frameRawData, frameScale
+from EchelleDataTools.FrameRegion import parseRegion, regionSection
+from EchelleDataTools.Instrumentation import addToStage, timedStage
 
 
-def plotImageAndHist(frame, savefig=False, fname=None):
+logger = logging.getLogger(f"{__name__}")
+
+
+## Rows of a frame binned at a time by the integer histogram path.
+_HIST_CHUNK_PIXELS = 1 << 22
+
+
+def histogramCounts(frame, edges):
     """
+    Returns the counts np.histogram(frame.data, edges) would
+    give. When the data are integer valued and edges are
+    regularly spaced integers, the counts are found with a
+    single np.bincount pass instead. The counts are cached
+    on the frame for as long as its data array is the same.
+    Compact frames with a BSCALE of 1 are binned on their raw
+    values, over edges shifted by BZERO.
     """
-    if not isinstance(frame, BaseFrame):
-        raise TypeError(f"frame object must inherit EchelleDataTools.Frame.BaseFrame")
+    data = frameRawData(frame)
+    key = np.asarray(edges, dtype=np.float64).tobytes()
+    cache = frame.__dict__.setdefault('_histogramCache', {})
+    cached = cache.get(key)
+    if (cached is not None) and (cached[0]() is data):
+        return cached[1]
+
+    bscale, bzero = frameScale(frame)
+    counts = None
+    if (bscale == 1) and float(bzero).is_integer() and (data.dtype.kind in 'iubf') and _isRegularIntegerEdges(edges):
+        counts = _integerHistogram(data, int(edges[0]) - int(bzero), int(edges[1] - edges[0]), len(edges) - 1)
+    if counts is None:
+        counts, _ = np.histogram(frameData(frame), edges)
+
+    cache[key] = (weakref.ref(data), counts)
+    return counts
+
+
+def _isRegularIntegerEdges(edges):
+    """
+    """
+    if len(edges) < 2:
+        return False
+    steps = np.diff(edges)
+    return bool(np.all(np.mod(edges, 1) == 0) and np.all(steps == steps[0]) and steps[0] > 0)
+
+
+def _integerHistogram(data, start, step, numBins):
+    """
+    Histogram of integer-valued data over numBins bins of
+    width step from start. Like np.histogram, the last bin
+    also holds values equal to its right edge, and values
+    outside the edges are ignored. Float data is checked to
+    be integer valued a chunk at a time, in the same pass;
+    returns None as soon as a chunk isn't.
+    """
+    stop = start + step*numBins
+    flat = data.reshape(-1)
+    counts = np.zeros(numBins, dtype=np.int64)
+    for i0 in range(0, flat.size, _HIST_CHUNK_PIXELS):
+        chunk = flat[i0:i0 + _HIST_CHUNK_PIXELS]
+        ## NaN and inf fail this too.
+        if (chunk.dtype.kind == 'f') and (not np.all(np.mod(chunk, 1) == 0)):
+            return None
+        values = chunk.astype(np.int64)
+        values = values[(values >= start) & (values <= stop)]
+        index = (values - start)//step
+        index[index == numBins] = numBins - 1
+        counts += np.bincount(index, minlength=numBins)
+    return counts
+
+
+def _unitEdges(frame):
+    """
+    Returns unit-width histogram edges from the smallest to
+    the largest value of frame in physical units, without
+    scaling a copy of it.
+    """
+    data = frameRawData(frame)
+    bscale, bzero = frameScale(frame)
+    if (bscale == 1) and (bzero == 0):
+        return np.arange(data.min(), data.max()+1, 1)
+    lo, hi = sorted((bscale*data.min().item() + bzero, bscale*data.max().item() + bzero))
+    return np.arange(lo, hi+1, 1)
+
+
+def _plotHistogram(axes, frame, edges):
+    """
+    Draws the histogram of frame over edges on axes, as a
+    single filled step patch on a log scale. This looks the
+    same as axes.hist(..., log=True) but doesn't draw one
+    patch per bin.
+    """
+    counts = histogramCounts(frame, edges)
+    axes.stairs(counts, edges, fill=True)
+    axes.set_yscale('log')
+
+
+## Number of pixels the stretch is built from when decimating.
+_STRETCH_SAMPLES = 1 << 18
+
 
-    fig, axes = plt.subplots(1, 2, figsize=(10,5))
+def _showImage(axes, frame, decimate=False, reduce='mean'):
+    """
+    Shows frame on axes with a histogram-equalized stretch.
+    With decimate, the stretch is built from a regular
+    subsample of the pixels (plus the data extremes), and the
+    image is block-reduced with reduce ('mean' or 'max') to
+    about the pixel size of the axes, and rasterized. Axes
+    coordinates stay in detector pixels either way.
+    """
+    data = frameData(frame)
+    if not decimate:
+        stretch = HistEqStretch(data)
+        norm = ImageNormalize(data, stretch=stretch)
+        axes.imshow(
+                data,
+                origin='lower',
+                cmap='gray',
+                norm=norm,
+                interpolation='none',
+                )
+        return
 
-    stretch = HistEqStretch(frame.data)
-    norm = ImageNormalize(frame.data, stretch=stretch)
+    step = max(1, int(np.ceil(np.sqrt(data.size/_STRETCH_SAMPLES))))
+    sample = np.concatenate([data[::step, ::step].ravel(), [np.nanmin(data), np.nanmax(data)]])
+    stretch = HistEqStretch(sample)
+    norm = ImageNormalize(sample, stretch=stretch)
 
-    axes[0].imshow(
-            frame.data,
+    extent = axes.get_window_extent()
+    factor = max(1, int(min(data.shape[0]/max(1, extent.height), data.shape[1]/max(1, extent.width))))
+    axes.imshow(
+            _blockReduce(data, factor, reduce),
             origin='lower',
             cmap='gray',
             norm=norm,
             interpolation='none',
+            extent=(-0.5, data.shape[1] - 0.5, -0.5, data.shape[0] - 0.5),
+            rasterized=True,
             )
+
+
+def _blockReduce(data, factor, reduce='mean'):
+    """
+    Reduces data by factor along both axes, taking the mean
+    or max of each factor x factor block. Rows and columns
+    that don't fill a whole block are dropped.
+    """
+    if factor <= 1:
+        return data
+    nRows = (data.shape[0]//factor)*factor
+    nCols = (data.shape[1]//factor)*factor
+    blocks = data[:nRows, :nCols].reshape(nRows//factor, factor, nCols//factor, factor)
+    match reduce:
+        case 'mean':
+            return blocks.mean(axis=(1, 3), dtype=np.float64)
+        case 'max':
+            return blocks.max(axis=(1, 3))
+        case _:
+            raise ValueError(f"reduce must be 'mean' or 'max', not {reduce!r}")
+
+
+def _saveFigure(fig, fname, fmt='svg', dpi=None):
+    """
+    Saves and closes fig, so batches of plots don't pile up
+    open figures.
+    """
+    fig.savefig(
+            fname,
+            format=fmt,
+            dpi=dpi if dpi is not None else 'figure',
+            )
+    plt.close(fig)
+
+
+@timedStage('plot')
+def plotImageAndHist(frame, savefig=False, fname=None, fmt='svg', dpi=None, decimate=False, reduce='mean'):
+    """
+    fmt and dpi are passed to savefig, e.g. fmt='png' for a
+    raster file. With decimate the image is drawn from a
+    reduced copy of the data; see _showImage.
+    """
+    if not isinstance(frame, BaseFrame):
+        raise TypeError(f"frame object must inherit EchelleDataTools.Frame.BaseFrame")
+    addToStage(frames=1)
+
+    fig, axes = plt.subplots(1, 2, figsize=(10,5), dpi=dpi)
+
+    _showImage(axes[0], frame, decimate=decimate, reduce=reduce)
     axes[0].set_title(frame.name.title() if isinstance(frame.name, str) else "Frame")
     
-    axes[1].hist(
-            frame.data.ravel(),
-            bins=np.arange(frame.data.min(), frame.data.max()+1, 1),
-            log=True,
+    _plotHistogram(
+            axes[1],
+            frame,
+            _unitEdges(frame),
             )
     axes[1].set_title('Histogram')
     axes[1].set_xlabel('Pixel Value [DN]')
@@ -46,14 +226,13 @@ def plotImageAndHist(frame, savefig=False, fname=None):
     else:
         if not fname:
             fname=frame.name
-        plt.savefig(
-                fname,
-                format='svg',
-                )
+        _saveFigure(fig, fname, fmt=fmt, dpi=dpi)
 
 
-def plotImageAndHistMulti(frames : list, savefig=False, fname=None):
+@timedStage('plot')
+def plotImageAndHistMulti(frames : list, savefig=False, fname=None, fmt='svg', dpi=None, decimate=False, reduce='mean'):
     """
+    See plotImageAndHist for fmt, dpi, decimate and reduce.
     """
     if not isinstance(frames, list):
         raise TypeError(f"Frames argument must be of type list.")
@@ -62,26 +241,18 @@ def plotImageAndHistMulti(frames : list, savefig=False, fname=None):
         raise TypeError(f"Objects in list frames must inherit EchelleDataTools.Frame.BaseFrame.")
 
     numFrame = len(frames)
+    addToStage(frames=numFrame)
 
-    fig, axes = plt.subplots(numFrame, 2, figsize=(10,10) )
+    fig, axes = plt.subplots(numFrame, 2, figsize=(10,10), dpi=dpi, squeeze=False)
 
     for row, f in enumerate(frames):
-        stretch = HistEqStretch(f.data)
-        norm = ImageNormalize(f.data, stretch=stretch)
-
-        axes[row, 0].imshow(
-                f.data,
-                origin='lower',
-                cmap='gray',
-                norm=norm,
-                interpolation='none',
-                )
+        _showImage(axes[row, 0], f, decimate=decimate, reduce=reduce)
         axes[row, 0].set_title(f.name.title() if isinstance(f.name, str) else "Frame")
         
-        axes[row, 1].hist(
-                f.data.ravel(),
-                bins=np.arange(frame.data.min(), frame.data.max()+1, 1),
-                log=True,
+        _plotHistogram(
+                axes[row, 1],
+                f,
+                _unitEdges(f),
                 )
         axes[row, 1].set_title('Histogram')
         axes[row, 1].set_xlabel('Pixel Value [DN]')
@@ -92,15 +263,14 @@ def plotImageAndHistMulti(frames : list, savefig=False, fname=None):
         plt.show()
     else:
         if not fname:
-            fname=frame.name
-        plt.savefig(
-                fname,
-                format='svg',
-                )
+            fname=frames[0].name
+        _saveFigure(fig, fname, fmt=fmt, dpi=dpi)
 
 
-def plotImageMulti(frames : list, savefig=False, fname=None):
+@timedStage('plot')
+def plotImageMulti(frames : list, savefig=False, fname=None, fmt='svg', dpi=None, decimate=False, reduce='mean'):
     """
+    See plotImageAndHist for fmt, dpi, decimate and reduce.
     """
     if not isinstance(frames, list):
         raise TypeError(f"Frames argument must be of type list.")
@@ -109,23 +279,14 @@ def plotImageMulti(frames : list, savefig=False, fname=None):
         raise TypeError(f"Objects in list frames must inherit EchelleDataTools.Frame.BaseFrame.")
 
     numFrame = len(frames)
+    addToStage(frames=numFrame)
 
     numRows = int(np.ceil( np.sqrt(numFrame) ))
-    fig, axes = plt.subplots( numRows, int(np.ceil(numFrame/numRows)), figsize=(8,10) )
+    fig, axes = plt.subplots( numRows, int(np.ceil(numFrame/numRows)), figsize=(8,10), dpi=dpi, squeeze=False )
 
-    if numFrame > 1:
-        axes = axes.flatten() ## Flatten axes grid so we can iterate through them.
+    axes = axes.flatten() ## Flatten axes grid so we can iterate through them.
     for row, f in enumerate(frames):
-        stretch = HistEqStretch(f.data)
-        norm = ImageNormalize(f.data, stretch=stretch)
-
-        axes[row].imshow(
-                f.data,
-                origin='lower',
-                cmap='gray',
-                norm=norm,
-                interpolation='none',
-                )
+        _showImage(axes[row], f, decimate=decimate, reduce=reduce)
         axes[row].set_title(f.name.title() if isinstance(f.name, str) else "Frame")
 
     for a in  axes[row+1:]:
@@ -136,14 +297,13 @@ def plotImageMulti(frames : list, savefig=False, fname=None):
         plt.show()
     else:
         if not fname:
-            fname=frame.name
-        plt.savefig(
-                fname,
-                format='svg',
-                )
+            fname=frames[0].name
+        _saveFigure(fig, fname, fmt=fmt, dpi=dpi)
 
-def plotHistMulti(frames : list, savefig=False, fname=None):
+@timedStage('plot')
+def plotHistMulti(frames : list, savefig=False, fname=None, fmt='svg', dpi=None):
     """
+    See plotImageAndHist for fmt and dpi.
     """
     if not isinstance(frames, list):
         raise TypeError(f"Frames argument must be of type list.")
@@ -152,18 +312,18 @@ def plotHistMulti(frames : list, savefig=False, fname=None):
         raise TypeError(f"Objects in list frames must inherit EchelleDataTools.Frame.BaseFrame.")
 
     numFrame = len(frames)
+    addToStage(frames=numFrame)
 
     numRows = int(np.ceil( np.sqrt(numFrame) ))
-    fig, axes = plt.subplots( numRows, int(np.ceil(numFrame/numRows)), figsize=(8,10) )
+    fig, axes = plt.subplots( numRows, int(np.ceil(numFrame/numRows)), figsize=(8,10), dpi=dpi, squeeze=False )
 
-    if numFrame > 1:
-        axes = axes.flatten() ## Flatten axes grid so we can iterate through them.
+    axes = axes.flatten() ## Flatten axes grid so we can iterate through them.
     for row, f in enumerate(frames):
         
-        axes[row].hist(
-                f.data.ravel(),
-                bins=np.arange(0, (1 << 16)+1, 512), # 0 -- 65536, with 512 stepsize.
-                log=True,
+        _plotHistogram(
+                axes[row],
+                f,
+                np.arange(0, (1 << 16)+1, 512), # 0 -- 65536, with 512 stepsize.
                 )
         axes[row].set_title(f.name.title() if isinstance(f.name, str) else "Frame")
 
@@ -175,11 +335,153 @@ def plotHistMulti(frames : list, savefig=False, fname=None):
         plt.show()
     else:
         if not fname:
-            fname=frame.name
-        plt.savefig(
-                fname,
-                format='svg',
-                )
+            fname=frames[0].name
+        _saveFigure(fig, fname, fmt=fmt, dpi=dpi)
+
+
+@dataclass
+class PlotJob:
+    """
+    One figure for renderPlotJobs. function is one of the plot
+    functions of this module, or its name. frames is what that
+    function takes: a frame for plotImageAndHist, a list of
+    frames otherwise. options are extra keyword arguments,
+    e.g. fmt='png' or decimate=True.
+    """
+    function : object
+    frames : object
+    fname : str
+    options : dict = field(default_factory=dict)
+
 
+@timedStage('plot')
+def renderPlotJobs(jobs : list, maxWorkers=None):
+    """
+    Renders each PlotJob to its file over a pool of maxWorkers
+    processes using the non-interactive Agg backend, and
+    returns the file names in job order. Lazy frames whose
+    data isn't in memory are read by the worker from their
+    file, and frames of a memory mapped frame cube are mapped
+    from the cube; any other frame (e.g. a SuperFrame, or a
+    Frame whose data may have been changed) is copied once
+    into shared memory. Pixel data is never pickled.
+    """
+    if not all(isinstance(job, PlotJob) for job in jobs):
+        raise TypeError("jobs must be a list of PlotJob objects.")
+
+    blocks = {}
+    try:
+        specs = [
+                (_plotFunctionName(job.function), _frameSpecs(job.frames, blocks), job.fname, job.options)
+                for job in jobs
+                ]
+        with ProcessPoolExecutor(max_workers=maxWorkers, initializer=_initPlotWorker) as executor:
+            futures = [executor.submit(_renderPlotJob, spec) for spec in specs]
+            return [f.result() for f in futures]
+    finally:
+        for block, _ in blocks.values():
+            block.close()
+            block.unlink()
+
+
+def _plotFunctionName(function):
+    """
+    """
+    name = function if isinstance(function, str) else getattr(function, '__name__', None)
+    if (name not in __all__) or (not name.startswith('plot')):
+        raise ValueError(f"{function!r} is not a plot function of EchellePlotTools.")
+    return name
 
 
+def _frameSpecs(frames, blocks):
+    """
+    Returns a picklable description of frames, which is a
+    frame or a list of frames. A LazyFrame whose data isn't
+    in memory is read from its file by the worker, and a
+    CubeFrame memory mapping its cube from the cube. Any other
+    frame, whose data may have been changed since it was
+    read, has its data copied into a shared memory block,
+    one per frame, kept in blocks.
+    """
+    if isinstance(frames, BaseFrame):
+        return _frameSpec(frames, blocks)
+    return [_frameSpec(f, blocks) for f in frames]
+
+
+def _frameSpec(frame, blocks):
+    """
+    """
+    if not isinstance(frame, BaseFrame):
+        raise TypeError("Objects in list frames must inherit EchelleDataTools.Frame.BaseFrame.")
+
+    ## Only a shared mapping of the cube shows the worker what the frame holds now.
+    if isinstance(frame, CubeFrame) and isinstance(frame.data, np.memmap) and (frame.data.mode in ('r', 'r+')):
+        return ('cube', frame.name, frame.cubeFile, frame.cubeIndex, frame.bscale, frame.bzero)
+
+    if isinstance(frame, LazyFrame) and (not frame.isResident):
+        region = None if frame.region is None else regionSection(frame.region)
+        return ('file', frame.name, frame.fileName, frame.hduIndex, frame.compressed, region)
+
+    if id(frame) not in blocks:
+        data = np.asarray(frameData(frame))
+        block = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+        blocks[id(frame)] = (block, (block.name, data.shape, data.dtype.str))
+    return ('shared', frame.name) + blocks[id(frame)][1]
+
+
+def _initPlotWorker():
+    """
+    """
+    matplotlib.use('Agg', force=True)
+
+
+def _loadFrameSpecs(specs, attached):
+    """
+    Rebuilds the frames described by _frameSpecs in a worker.
+    """
+    if isinstance(specs, tuple):
+        return _loadFrameSpec(specs, attached)
+    return [_loadFrameSpec(spec, attached) for spec in specs]
+
+
+def _loadFrameSpec(spec, attached):
+    """
+    """
+    match spec[0]:
+        case 'file':
+            _, name, fileName, hduIndex, compressed, region = spec
+            ## Only the region is read, or decompressed, from the file.
+            return LazyFrame(header=None, fileName=fileName, hduIndex=hduIndex, compressed=compressed,
+                    region=parseRegion(region), name=name)
+        case 'cube':
+            _, name, cubeFile, cubeIndex, bscale, bzero = spec
+            data = np.load(cubeFile, mmap_mode='r')[cubeIndex]
+            return Frame(data=data, header=None, name=name, bscale=bscale, bzero=bzero)
+        case 'shared':
+            _, name, blockName, shape, dtype = spec
+            block = shared_memory.SharedMemory(name=blockName)
+            attached.append(block)
+            return BaseFrame(data=np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf), name=name)
+
+
+def _renderPlotJob(spec):
+    """
+    Runs one plot job in a worker, returning its file name.
+    """
+    functionName, frameSpecs, fname, options = spec
+    attached = []
+    try:
+        frames = _loadFrameSpecs(frameSpecs, attached)
+        getattr(sys.modules[__name__], functionName)(frames, savefig=True, fname=fname, **options)
+        plt.close('all')
+        del frames
+    finally:
+        ## Drop the figure's references to the shared buffers before detaching.
+        gc.collect()
+        for block in attached:
+            try:
+                block.close()
+            except BufferError:
+                logger.debug(f"Shared block {block.name} still in use; it is released at worker exit.")
+    return fname
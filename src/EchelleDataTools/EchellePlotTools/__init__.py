@@ -4,3 +4,11 @@ __all__ = ['EchellePlotTools']
 
 
 from . import EchellePlotTools
+
+
+def __getattr__(name):
+    """
+    Forwards to the EchellePlotTools module, so this
+    package can stand in for it.
+    """
+    return getattr(EchellePlotTools, name)
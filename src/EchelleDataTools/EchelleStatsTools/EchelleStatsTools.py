@@ -1,32 +1,155 @@
 #! /usr/bin/env python3
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 
 import numpy as np
 from scipy.special import erf
 from scipy.stats import t
 
+from EchelleDataTools.Frame import BaseFrame, LazyFrame
+from EchelleDataTools.FrameCombine import frameRawData, frameScale, frameShape, readTile, tileSlices, DEFAULT_MAX_TILE_BYTES
+from EchelleDataTools.Instrumentation import addToStage, stage
+
+
+## Default size of the float64 chunk the per-frame moments are accumulated over.
+DEFAULT_CHUNK_BYTES = 64 * (1 << 20)
+
+
+def frameMoments(a, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Returns the mean and (population) variance of each frame
+    a[i] of a stack a, as two arrays of length a.shape[0].
+    The stack is read once, in chunks of rows along axis 1,
+    and the per-chunk moments are merged with Chan's parallel
+    update of Welford's algorithm, so a memory-mapped stack
+    never has to be in memory all at once.
+    """
+    if a.ndim == 1:
+        a = a.reshape(a.shape[0], 1)
+
+    numFrames = a.shape[0]
+    rowSize = int(np.prod(a.shape[2:], dtype=np.int64))
+    step = max(1, chunkBytes // max(1, 8 * numFrames * rowSize))
+
+    count = 0
+    means = np.zeros(numFrames, dtype=np.float64)
+    m2 = np.zeros(numFrames, dtype=np.float64)
+    for r0 in range(0, a.shape[1], step):
+        chunk = a[:, r0:r0 + step].reshape(numFrames, -1)
+        chunkCount = chunk.shape[1]
+        chunkMeans = chunk.mean(axis=1, dtype=np.float64)
+        deviation = chunk - chunkMeans[:, None]
+        chunkM2 = np.einsum('ij,ij->i', deviation, deviation)
+
+        delta = chunkMeans - means
+        total = count + chunkCount
+        means += delta * (chunkCount / total)
+        m2 += chunkM2 + delta**2 * (count * chunkCount / total)
+        count = total
+
+    return means, m2 / count
+
+
+def _passData(f):
+    """
+    Raw data of a frame for a single pass over it. A LazyFrame
+    that isn't resident is read with LazyFrame.readData, so the
+    pass doesn't leave it in memory.
+    """
+    if isinstance(f, LazyFrame) and (not f.isResident):
+        return f.readData()
+    return frameRawData(f)
+
+
+def streamFrameMoments(frames, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Same as frameMoments, for any iterable of Frame objects
+    (e.g. EchelleDataSequence.biasFrames) or 2D arrays. The
+    frames are visited once, one at a time, so no stack of
+    them is ever built. The moments of compact frames are
+    taken over their raw values and then scaled, since the
+    mean and variance scale linearly with BSCALE and BZERO.
+    Lazy frames that aren't resident are read without being
+    kept, so they still aren't resident afterwards.
+    """
+    means = []
+    variances = []
+    for f in frames:
+        if not isinstance(f, (BaseFrame, np.ndarray)):
+            raise TypeError("Frames must be numpy.ndarray or inherit EchelleDataTools.Frame.BaseFrame.")
+        bscale, bzero = frameScale(f)
+        mean, var = frameMoments(_passData(f)[np.newaxis], chunkBytes=chunkBytes)
+        means.append(bscale*mean[0] + bzero)
+        variances.append(bscale**2 * var[0])
+    if not means:
+        raise ValueError("No frames to calculate moments of.")
+    return np.array(means), np.array(variances)
+
+
+def framesMean(frames, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Returns the mean of every pixel of every frame in frames,
+    a stack or an iterable of Frame objects or arrays, without
+    stacking them, or making lazy frames resident. Replaces
+    np.mean([f.data for f in frames]).
+    """
+    if isinstance(frames, np.ndarray):
+        means, _ = frameMoments(frames, chunkBytes=chunkBytes)
+        return np.float64( means.mean() )
+
+    total = np.float64(0)
+    count = 0
+    for f in frames:
+        if not isinstance(f, (BaseFrame, np.ndarray)):
+            raise TypeError("Frames must be numpy.ndarray or inherit EchelleDataTools.Frame.BaseFrame.")
+        bscale, bzero = frameScale(f)
+        data = _passData(f)
+        total += bscale*data.sum(dtype=np.float64) + bzero*data.size
+        count += data.size
+    if count == 0:
+        raise ValueError("No frames to calculate the mean of.")
+    return np.float64( total/count )
+
+
+def _moments(a, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Per-frame moments of a stack, or of an iterable of frames.
+    """
+    if isinstance(a, np.ndarray):
+        moments = frameMoments(a, chunkBytes=chunkBytes)
+    elif isinstance(a, (str, bytes)) or not hasattr(a, '__iter__'):
+        raise TypeError(
+                f"Input type {type(a)} must be an instance of numpy.ndarray, or an iterable of frames"
+                )
+    else:
+        moments = streamFrameMoments(a, chunkBytes=chunkBytes)
+    addToStage(frames=len(moments[0]))
+    return moments
+
 
 class EchelleTtestSingle(object):
 
-    def __init__(self, a, value):
+    def __init__(self, a, value, chunkBytes=DEFAULT_CHUNK_BYTES):
         """
+        a may be any numpy.ndarray, including a numpy.memmap,
+        or an iterable of Frame objects or 2D arrays such as
+        EchelleDataSequence.biasFrames. Each frame's moments
+        are found in a single chunked pass; see frameMoments
+        and streamFrameMoments.
         """
-        ### First check that a is a numpy array.
-        if type(a) is not np.ndarray:
-            raise TypeError(
-                    f"Input a type {type(a)} must be an instance of numpy.ndarray"
-                    )
-        self._calculateT(a, value)
-        self._calculateP()
+        self.chunkBytes = chunkBytes
+        with stage('stats', type(self).__name__):
+            self._calculateT(a, value)
+            self._calculateP()
 
     def _calculateT(self, a, value):
         """
         """
-        self._calculateMeans(a)
-        self._calculatePooledStd(a)
+        self._calculateMoments(a)
+        self._calculatePooledStd()
         self.t = np.float64( np.abs( self.means.mean() - value)/self.pooledStd)
-        self.df = np.int32( a.shape[0] - 1)
+        self.df = np.int32( len(self.means) - 1)
         self.value = np.float64( value )
 
     def _calculateP(self):
@@ -34,15 +157,15 @@ class EchelleTtestSingle(object):
         """
         self.p = np.float64( 1 - (t.cdf(self.t, self.df) - t.cdf(-self.t, self.df)) )
 
-    def _calculateMeans(self, a):
+    def _calculateMoments(self, a):
         """
         """
-        self.means = np.array( [a[i].mean() for i in range(a.shape[0]) ])
+        self.means, self.vars = _moments(a, chunkBytes=self.chunkBytes)
 
-    def _calculatePooledStd(self, a):
+    def _calculatePooledStd(self):
         """
         """
-        var = np.sum( [a[i].var()*a[i].size for i in range(a.shape[0]) ])/a.size/a.shape[0]
+        var = self.vars.sum()/len(self.vars)/len(self.vars)
         self.pooledStd = np.float64( np.sqrt(var) )
 
     def __str__(self):
@@ -58,40 +181,41 @@ class EchelleTtestSingle(object):
 
 class EchelleTtestIndep(object):
 
-    def __init__(self, a, b):
-        if (type(a) is not np.ndarray) or (type(b) is not np.ndarray):
-            raise TypeError(
-                    f"Input a type {type(a)} {type(b)} must be an instance of numpy.ndarray"
-                    )
-        self._calculateT(a, b)
-        self._calculateP()
+    def __init__(self, a, b, chunkBytes=DEFAULT_CHUNK_BYTES):
+        """
+        See EchelleTtestSingle for the accepted inputs.
+        """
+        self.chunkBytes = chunkBytes
+        with stage('stats', type(self).__name__):
+            self._calculateT(a, b)
+            self._calculateP()
 
     def _calculateT(self, a, b):
         """
         """
-        self._calculateMeans(a, b)
-        self._calculatePooledStd(a, b)
+        self._calculateMoments(a, b)
+        self._calculatePooledStd()
         self.t = np.float64(
                 np.abs( self.meansA.mean() - self.meansB.mean())/self.pooledStd
                 )
-        self.df = np.int32( (a.shape[0] -1) + (b.shape[0] -1))
+        self.df = np.int32( (len(self.meansA) -1) + (len(self.meansB) -1))
 
     def _calculateP(self):
         """
         """
         self.p = np.float64( 1 - (t.cdf(self.t, self.df) - t.cdf(-self.t, self.df)) )
 
-    def _calculateMeans(self, a, b):
+    def _calculateMoments(self, a, b):
         """
         """
-        self.meansA = np.array( [ a[i].mean() for i in range(a.shape[0]) ])
-        self.meansB = np.array( [ b[i].mean() for i in range(b.shape[0]) ])
+        self.meansA, self.varsA = _moments(a, chunkBytes=self.chunkBytes)
+        self.meansB, self.varsB = _moments(b, chunkBytes=self.chunkBytes)
 
-    def _calculatePooledStd(self, a, b):
+    def _calculatePooledStd(self):
         """
         """
-        varA = np.sum( [a[i].var()*a[i].size for i in range(a.shape[0]) ])/a.size/a.shape[0]
-        varB = np.sum( [b[i].var()*b[i].size for i in range(b.shape[0]) ])/b.size/b.shape[0]
+        varA = self.varsA.sum()/len(self.varsA)/len(self.varsA)
+        varB = self.varsB.sum()/len(self.varsB)/len(self.varsB)
         self.pooledStd = np.float64(
                 np.sqrt( (varA + varB)/2 )
                 )
@@ -107,6 +231,246 @@ class EchelleTtestIndep(object):
         return self.__str__()
 
 
+class EchelleTtestPixelwise(object):
+    """
+    Two-sample t-test of every pixel between two sets of
+    frames, giving maps of t, p and df. t is signed (a - b)
+    and p is two-sided. With equalVar the pooled-variance
+    test is used, and df is nA + nB - 2 everywhere;
+    otherwise Welch's test, with a Welch-Satterthwaite df
+    per pixel.
+
+    a and b may be (N, H, W) arrays (including memmaps), or
+    lists of Frame objects or 2D arrays. The detector is
+    processed in tiles of at most maxTileBytes of float64
+    working memory, spread over maxWorkers threads.
+    """
+
+    def __init__(self, a, b, equalVar=True, maxTileBytes=DEFAULT_MAX_TILE_BYTES, maxWorkers=1):
+        """
+        """
+        self.framesA = _asFrameList(a)
+        self.framesB = _asFrameList(b)
+        if (len(self.framesA) < 2) or (len(self.framesB) < 2):
+            raise ValueError("Each set needs at least two frames for a pixelwise t-test.")
+
+        self.shape = frameShape(self.framesA[0])
+        if frameShape(self.framesB[0]) != self.shape:
+            raise ValueError(f"Frame shapes differ: {self.shape} and {frameShape(self.framesB[0])}")
+
+        self.equalVar = equalVar
+        self.nA = len(self.framesA)
+        self.nB = len(self.framesB)
+        self.t = np.empty(self.shape, dtype=np.float64)
+        self.p = np.empty(self.shape, dtype=np.float64)
+        self.df = np.empty(self.shape, dtype=np.float64)
+
+        ## Two float64 values per frame and pixel: the tile stack and its deviations.
+        tiles = list(tileSlices(self.shape, self.nA + self.nB, 16, maxTileBytes))
+        with stage('stats', type(self).__name__, frames=self.nA + self.nB):
+            if (maxWorkers is None) or (maxWorkers > 1):
+                with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                    for _ in executor.map(self._calculateTile, tiles):
+                        pass
+            else:
+                for tile in tiles:
+                    self._calculateTile(tile)
+
+        self.framesA = self.framesB = None
+
+    def _calculateTile(self, tile):
+        """
+        """
+        rows, cols = tile
+        meanA, varA = _tileMoments(self.framesA, rows, cols)
+        meanB, varB = _tileMoments(self.framesB, rows, cols)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.equalVar:
+                df = np.float64(self.nA + self.nB - 2)
+                pooled = ((self.nA - 1)*varA + (self.nB - 1)*varB)/df
+                stdErr = np.sqrt(pooled*(1/self.nA + 1/self.nB))
+                self.df[rows, cols] = df
+            else:
+                seA = varA/self.nA
+                seB = varB/self.nB
+                stdErr = np.sqrt(seA + seB)
+                self.df[rows, cols] = (seA + seB)**2/(seA**2/(self.nA - 1) + seB**2/(self.nB - 1))
+            tTile = (meanA - meanB)/stdErr
+
+        self.t[rows, cols] = tTile
+        self.p[rows, cols] = 2*t.sf(np.abs(tTile), self.df[rows, cols])
+
+    def __str__(self):
+        """
+        """
+        return f"EchelleTtestPixelwise(shape={self.shape}, nA={self.nA}, nB={self.nB}, equalVar={self.equalVar}, median |t|={np.nanmedian(np.abs(self.t)):.6f})"
+
+    def __repr__(self):
+        """
+        """
+        return self.__str__()
+
+
+def _indepT(meansA, varsA, meansB, varsB):
+    """
+    The EchelleTtestIndep statistic, vectorized over any
+    leading axes of the per-frame means and variances.
+    """
+    nA = meansA.shape[-1]
+    nB = meansB.shape[-1]
+    varA = varsA.sum(axis=-1)/nA/nA
+    varB = varsB.sum(axis=-1)/nB/nB
+    return np.abs( meansA.mean(axis=-1) - meansB.mean(axis=-1))/np.sqrt( (varA + varB)/2 )
+
+
+def _permutationBlock(block):
+    """
+    Statistics of one block of label permutations.
+    """
+    meansA, varsA, meansB, varsB, size, seed = block
+    rng = np.random.default_rng(seed)
+    nA = len(meansA)
+    means = np.concatenate([meansA, meansB])
+    variances = np.concatenate([varsA, varsB])
+
+    order = rng.permuted(np.tile(np.arange(len(means)), (size, 1)), axis=1)
+    return _indepT(
+            means[order[:, :nA]], variances[order[:, :nA]],
+            means[order[:, nA:]], variances[order[:, nA:]],
+            )
+
+
+def _bootstrapBlock(block):
+    """
+    Statistics of one block of null-centered bootstrap resamples.
+    """
+    meansA, varsA, meansB, varsB, size, seed = block
+    rng = np.random.default_rng(seed)
+    pooledMean = np.concatenate([meansA, meansB]).mean()
+    centeredA = meansA - meansA.mean() + pooledMean
+    centeredB = meansB - meansB.mean() + pooledMean
+
+    pickA = rng.integers(0, len(meansA), size=(size, len(meansA)))
+    pickB = rng.integers(0, len(meansB), size=(size, len(meansB)))
+    return _indepT(
+            centeredA[pickA], varsA[pickA],
+            centeredB[pickB], varsB[pickB],
+            )
+
+
+class EchelleResampleIndep(object):
+    """
+    Base class for resampling versions of EchelleTtestIndep.
+    The per-frame means and variances of a and b are found
+    once, so each resample only shuffles N summary values.
+    Resamples are drawn in fixed blocks, each with its own
+    child of numpy.random.SeedSequence(seed), so results for
+    a given seed don't depend on maxWorkers. With maxWorkers
+    > 1 (or None) the blocks run over a process pool.
+    """
+
+    ## Module-level function run on each block of resamples.
+    _blockFunction = None
+
+    def __init__(self, a, b, nResamples=10000, seed=None, maxWorkers=1,
+            blockSize=1000, chunkBytes=DEFAULT_CHUNK_BYTES):
+        """
+        a and b are accepted as by EchelleTtestIndep.
+        """
+        with stage('stats', type(self).__name__):
+            self.meansA, self.varsA = _moments(a, chunkBytes=chunkBytes)
+            self.meansB, self.varsB = _moments(b, chunkBytes=chunkBytes)
+            self.t = np.float64( _indepT(self.meansA, self.varsA, self.meansB, self.varsB) )
+            self.df = np.int32( (len(self.meansA) -1) + (len(self.meansB) -1))
+            self.nResamples = nResamples
+            self.seed = seed
+            self._resample(nResamples, seed, maxWorkers, blockSize)
+
+    def _resample(self, nResamples, seed, maxWorkers, blockSize):
+        """
+        """
+        sizes = [min(blockSize, nResamples - start) for start in range(0, nResamples, blockSize)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        blocks = [
+                (self.meansA, self.varsA, self.meansB, self.varsB, size, childSeed)
+                for size, childSeed in zip(sizes, seeds)
+                ]
+
+        blockFunction = type(self)._blockFunction
+        if ((maxWorkers is None) or (maxWorkers > 1)) and (len(blocks) > 1):
+            with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+                results = list(executor.map(blockFunction, blocks))
+        else:
+            results = [blockFunction(block) for block in blocks]
+
+        self.tResamples = np.concatenate(results) if results else np.empty(0)
+        self.p = np.float64( (np.count_nonzero(self.tResamples >= self.t) + 1)/(len(self.tResamples) + 1) )
+
+    def __str__(self):
+        """
+        """
+        return f"t={self.t:.9f} p={self.p:.9f} df={self.df} nResamples={self.nResamples} meanA={self.meansA.mean()} meanB={self.meansB.mean()}"
+
+    def __repr__(self):
+        """
+        """
+        return self.__str__()
+
+
+class EchellePermutationIndep(EchelleResampleIndep):
+    """
+    Permutation test of the EchelleTtestIndep statistic: the
+    frames of a and b are pooled and randomly relabelled into
+    sets of the original sizes. p is the fraction of
+    relabellings with a statistic at least as large as the
+    observed one.
+    """
+
+    _blockFunction = staticmethod(_permutationBlock)
+
+
+class EchelleBootstrapIndep(EchelleResampleIndep):
+    """
+    Bootstrap test of the EchelleTtestIndep statistic. Each
+    set's frame means are shifted to the pooled mean, to
+    impose the null hypothesis, and frames are resampled
+    with replacement within each set. p is the fraction of
+    resamples with a statistic at least as large as the
+    observed one.
+    """
+
+    _blockFunction = staticmethod(_bootstrapBlock)
+
+
+def _asFrameList(x):
+    """
+    Returns x as a list of frames: the frames of an
+    (N, H, W) array, or the items of a list of Frame
+    objects or 2D arrays.
+    """
+    if isinstance(x, np.ndarray):
+        if x.ndim != 3:
+            raise ValueError(f"Frame stack must be 3D (N, H, W), got shape {x.shape}")
+        return [x[i] for i in range(x.shape[0])]
+    frames = list(x)
+    if not all(isinstance(f, (BaseFrame, np.ndarray)) for f in frames):
+        raise TypeError("Frames must be numpy.ndarray or inherit EchelleDataTools.Frame.BaseFrame.")
+    return frames
+
+
+def _tileMoments(frames, rows, cols):
+    """
+    Returns the per-pixel mean and sample variance (ddof=1)
+    of a tile over a list of frames.
+    """
+    shape = (rows.stop - rows.start, cols.stop - cols.start)
+    stack = np.empty((len(frames),) + shape, dtype=np.float64)
+    for i, f in enumerate(frames):
+        readTile(f, rows, cols, stack[i])
+    return stack.mean(axis=0), stack.var(axis=0, ddof=1)
+
+
 @dataclass
 class TTestResult():
     tStatistic: np.float64
@@ -3,3 +3,10 @@ __all__ = ['EchelleStatsTools']
 
 from . import EchelleStatsTools
 
+
+def __getattr__(name):
+    """
+    Forwards to the EchelleStatsTools module, so this
+    package can stand in for it.
+    """
+    return getattr(EchelleStatsTools, name)
@@ -1,23 +1,377 @@
 #!/usr/bin/env python3
 
+from .FrameRegion import offsetRegion
+from .Instrumentation import addToStage
+
 import astropy.io.fits as fits
+from collections import OrderedDict
 from dataclasses import dataclass, field
+import logging
 import numpy as np
+import threading
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Stored data types by FITS BITPIX.
+_BITPIX_DTYPES = {8 : np.uint8, 16 : np.int16, 32 : np.int32, 64 : np.int64, -32 : np.float32, -64 : np.float64}
+
+
+def physicalDtype(rawDtype, bscale=1, bzero=0):
+    """
+    Returns the smallest dtype that holds raw values of
+    rawDtype scaled by bscale and offset by bzero exactly.
+    Integers stay integers when bscale is 1 and bzero is a
+    whole number, e.g. int16 with a BZERO of 32768 is uint16.
+    Otherwise they are float32 up to 16 bits, and float64
+    above, as astropy does.
+    """
+
+    rawDtype = np.dtype(rawDtype).newbyteorder('=')
+    if (bscale == 1) and (bzero == 0):
+        return rawDtype
+    if rawDtype.kind == 'f':
+        return rawDtype
+    if (rawDtype.kind in 'iu') and (bscale == 1) and (float(bzero).is_integer()):
+        info = np.iinfo(rawDtype)
+        lo, hi = int(info.min) + int(bzero), int(info.max) + int(bzero)
+        if (lo >= np.iinfo(np.int64).min) and (hi <= np.iinfo(np.uint64).max):
+            dtype = np.result_type(np.min_scalar_type(lo), np.min_scalar_type(hi))
+            if dtype.kind in 'iu':
+                return dtype
+    return np.dtype(np.float32) if rawDtype.itemsize <= 2 else np.dtype(np.float64)
+
+
+def scaleInto(out, raw, bscale=1, bzero=0):
+    """
+    Writes raw*bscale + bzero into out, in out's dtype. An
+    integer out is offset in its own modular arithmetic, which
+    is exact as long as the result fits, as physicalDtype
+    makes sure it does.
+    """
+
+    out[...] = raw
+    if bscale != 1:
+        np.multiply(out, bscale, out=out, casting='unsafe')
+    if bzero != 0:
+        if out.dtype.kind in 'iu':
+            np.add(out, np.asarray(int(bzero)).astype(out.dtype), out=out)
+        else:
+            np.add(out, bzero, out=out, casting='unsafe')
+    return out
 
 
 @dataclass(kw_only=True)
 class BaseFrame:
+    """
+    region is the (rows, cols) slices of the detector that
+    data covers, in detector coordinates, or None for the
+    whole detector. See FrameRegion.
+    """
     data : np.ndarray = field(repr=False)
     name : str = None
+    region : tuple = field(default=None, repr=False)
 
 
 @dataclass(kw_only=True)
 class Frame(BaseFrame):
+    """
+    A frame read from a FITS file. A compact frame keeps
+    data as the raw stored integers, with the BZERO and
+    BSCALE of its header in bzero and bscale, rather than
+    as the scaled values astropy would give. Its values in
+    physical units (data*bscale + bzero) are returned by
+    scaledData. hduIndex is the HDU of fileName the data
+    was read from, e.g. 1 for the compressed image of a
+    .fits.fz file.
+    """
     header : fits.Header = field(repr=False)
+    fileName : str = None
+    hduIndex : int = 0
+    bzero : float = 0
+    bscale : float = 1
+
+    @property
+    def isCompact(self):
+        """
+        """
+        return (self.bscale != 1) or (self.bzero != 0)
+
+    @property
+    def dtype(self):
+        """
+        The dtype of the frame's values in physical units.
+        """
+        return physicalDtype(self.data.dtype, self.bscale, self.bzero)
+
+    @property
+    def shape(self):
+        """
+        """
+        return self.data.shape
+
+    def scaledData(self, dtype=None):
+        """
+        Returns the frame's values in physical units, as dtype
+        if given. Frames that are not compact return data as is.
+        """
+        data = self.data
+        if not self.isCompact:
+            return data if dtype is None else data.astype(dtype, copy=False)
+        out = np.empty(data.shape, dtype=dtype or self.dtype)
+        scaleInto(out, data, self.bscale, self.bzero)
+        return out
+
+    def readSection(self, rows, cols):
+        """
+        Returns the rows, cols section of data, as stored.
+        """
+        return self.data[rows, cols]
+
+
+@dataclass(kw_only=True)
+class CubeFrame(Frame):
+    """
+    A Frame whose data is a view of frame cubeIndex of the
+    (N, H, W) cube in cubeFile, as written by FrameCube. The
+    data is as it was stored when the cube was written, so
+    compact frames are still compact. fileName is the FITS
+    file the frame was first read from.
+    """
+    cubeFile : str = None
+    cubeIndex : int = None
 
 
 @dataclass(kw_only=True)
 class SuperFrame(BaseFrame):
+    """
+    exposureTime is the EXPTIME of the frames combined, or
+    None if they don't all have the same one.
+    """
     biasSubtracted : bool = None
     darkSubtracted : bool = None
     combineMethod : str = 'median'
+    combineOptions : dict = field(default_factory=dict)
+    outputDtype : str = None
+    exposureTime : float = None
+    provenance : str = field(default=None, repr=False)
+
+
+class FrameResidencyPool(object):
+    """
+    Keeps track of which LazyFrame objects hold their pixel
+    data in memory. When the resident data exceeds maxBytes,
+    the least recently used frames drop their data. It is
+    read back from the FITS file on the next access.
+    A maxBytes of None means no limit.
+    """
+
+    def __init__(self, maxBytes=None):
+        """
+        """
+        self.maxBytes = maxBytes
+        self.residentBytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.RLock()
+
+    def touch(self, frame):
+        """
+        Marks frame as the most recently used, and evicts
+        the least recently used frames if over budget.
+        The frame just touched is never evicted.
+        """
+        with self._lock:
+            key = id(frame)
+            if key in self._frames:
+                self._frames.move_to_end(key)
+            else:
+                self._frames[key] = frame
+                self.residentBytes += frame._nbytes
+            self._evict(keep=key)
+
+    def discard(self, frame):
+        """
+        Stops tracking frame, without dropping its data.
+        """
+        with self._lock:
+            if self._frames.pop(id(frame), None) is not None:
+                self.residentBytes -= frame._nbytes
+
+    def clear(self):
+        """
+        Drops the data of every frame in the pool.
+        """
+        with self._lock:
+            for frame in self._frames.values():
+                frame._release()
+            self._frames.clear()
+            self.residentBytes = 0
+
+    def _evict(self, keep=None):
+        """
+        """
+        if self.maxBytes is None:
+            return
+        while (self.residentBytes > self.maxBytes) and (len(self._frames) > 1):
+            key, frame = next(iter(self._frames.items()))
+            if key == keep:
+                break
+            del self._frames[key]
+            self.residentBytes -= frame._nbytes
+            logger.debug(f"Evicting {frame.name} from residency pool.")
+            frame._release()
+
+    def __len__(self):
+        """
+        """
+        return len(self._frames)
+
+    def __repr__(self):
+        """
+        """
+        return f"FrameResidencyPool(maxBytes={self.maxBytes}, residentBytes={self.residentBytes}, frames={len(self)})"
+
+
+@dataclass(kw_only=True, eq=False)
+class LazyFrame(Frame):
+    """
+    A Frame whose data is read from a memory-mapped FITS file
+    on first access, rather than when the frame is made. If
+    a residencyPool is given, the data is dropped again when
+    the pool evicts the frame. Assigning data pins it in
+    memory, since it can no longer be read back from the file.
+
+    compressed marks a tile compressed image. Sections of it
+    are read by decompressing only the tiles they overlap,
+    unless its data is already resident.
+    """
+    data : np.ndarray = field(default=None, repr=False)
+    residencyPool : FrameResidencyPool = field(default=None, repr=False)
+    compressed : bool = False
+
+    def __post_init__(self):
+        """
+        """
+        self._nbytes = 0
+
+    def _getData(self):
+        """
+        """
+        data = self.__dict__.get('_data')
+        if data is None:
+            data = self.readData()
+            self._data = data
+            self._nbytes = data.nbytes
+        if (self.residencyPool is not None) and (not self.__dict__.get('_pinned', False)):
+            self.residencyPool.touch(self)
+        return data
+
+    def readData(self):
+        """
+        Reads the frame's data, or its region, from its file,
+        without keeping it on the frame or in the residency pool,
+        so a one-off pass over the data doesn't leave it in
+        memory. Uncompressed data that needn't be scaled is
+        memory mapped.
+        """
+        ## astropy can't memory map data that needs scaling; it is read into memory instead.
+        ## Compact frames keep the raw values, which can always be memory mapped.
+        raw = self.isCompact
+        memmap = raw or (not self._isScaled())
+        with fits.open(self.fileName, memmap=memmap, do_not_scale_image_data=raw) as hdul:
+            hdu = hdul[self.hduIndex]
+            if self.region is None:
+                data = hdu.data
+            elif memmap and (not self.compressed):
+                data = hdu.data[self.region]
+            else:
+                ## Only read, or decompress, the pixels of the region.
+                data = hdu.section[self.region]
+        addToStage(bytesRead=data.nbytes)
+        return data
+
+    def _setData(self, value):
+        """
+        """
+        if value is None:
+            return
+        if self.residencyPool is not None:
+            self.residencyPool.discard(self)
+        self._data = value
+        self._nbytes = value.nbytes
+        self._pinned = True
+
+    @property
+    def dtype(self):
+        """
+        Taken from the header when it gives the dtype of data,
+        so the data needn't be read.
+        """
+        rawDtype = self._headerDtype()
+        if rawDtype is None:
+            return super().dtype
+        return physicalDtype(rawDtype, self.bscale, self.bzero)
+
+    @property
+    def shape(self):
+        """
+        Taken from the header or region, so the data needn't be read.
+        """
+        if self.isResident or (self.header is None) or ('NAXIS2' not in self.header):
+            return self.data.shape
+        if self.region is not None:
+            return tuple(s.stop - s.start for s in self.region)
+        return (self.header['NAXIS2'], self.header['NAXIS1'])
+
+    def _headerDtype(self):
+        """
+        Returns the dtype data will have, as given by BITPIX, or
+        None if that depends on how astropy scales the data.
+        """
+        if self.isResident or (self.header is None) or (self.header.get('BITPIX') not in _BITPIX_DTYPES):
+            return None
+        rawDtype = np.dtype(_BITPIX_DTYPES[self.header['BITPIX']])
+        if self.isCompact or (not self._isScaled()):
+            return rawDtype
+        ## astropy reads signed integers offset by half their range as unsigned integers.
+        if (rawDtype.kind == 'i') and ('BLANK' not in self.header) and (self.header.get('BSCALE', 1) == 1) \
+                and (self.header.get('BZERO', 0) == 1 << (8*rawDtype.itemsize - 1)):
+            return physicalDtype(rawDtype, 1, self.header['BZERO'])
+        return None
+
+    def readSection(self, rows, cols):
+        """
+        Reads only the section from the file, or only its tiles
+        of a compressed file, unless the data is resident, so
+        a tiled pass over the frame doesn't make it resident.
+        """
+        if self.isResident:
+            return self.data[rows, cols]
+        raw = self.isCompact
+        with fits.open(self.fileName, do_not_scale_image_data=raw) as hdul:
+            section = hdul[self.hduIndex].section[offsetRegion((rows, cols), self.region)]
+        addToStage(bytesRead=section.nbytes)
+        return section
+
+    def _isScaled(self):
+        """
+        """
+        if self.header is None:
+            return True
+        return any(card in self.header for card in ('BZERO', 'BSCALE', 'BLANK'))
+
+    def _release(self):
+        """
+        Drops the frame's data. Arrays already handed out stay valid.
+        """
+        self._data = None
+
+    @property
+    def isResident(self):
+        """
+        """
+        return self.__dict__.get('_data') is not None
+
+
+LazyFrame.data = property(LazyFrame._getData, LazyFrame._setData)
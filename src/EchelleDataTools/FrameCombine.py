@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+__all__ = ['combineParallel', 'combineTiled', 'compactStackDtype', 'frameData', 'frameDtype', 'frameRawData',
+        'frameScale', 'frameShape', 'getReducer', 'readTile', 'tileSlices', 'COMBINE_METHODS', 'DEFAULT_MAX_TILE_BYTES']
+
+
+from .Frame import BaseFrame, Frame, scaleInto
+from .FrameRegion import offsetRegion, resolveRegion
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import logging
+from multiprocessing import shared_memory
+import numpy as np
+import os
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Default ceiling on the size of one tile of the frame stack.
+DEFAULT_MAX_TILE_BYTES = 256 * (1 << 20)
+
+
+def frameData(frame):
+    """
+    Returns the pixel array of frame in physical units. frame
+    may be a BaseFrame or already an array. LazyFrame data is
+    fetched through its residency pool on each call, and
+    compact frames are scaled into a new array.
+    """
+
+    if isinstance(frame, Frame):
+        return frame.scaledData()
+    return frame.data if isinstance(frame, BaseFrame) else frame
+
+
+def frameRawData(frame):
+    """
+    Returns the pixel array of frame as stored, i.e. unscaled
+    for compact frames. Use with frameScale.
+    """
+
+    return frame.data if isinstance(frame, BaseFrame) else frame
+
+
+def frameScale(frame):
+    """
+    Returns (bscale, bzero) relating frameRawData(frame) to
+    its values in physical units.
+    """
+
+    if isinstance(frame, Frame):
+        return frame.bscale, frame.bzero
+    return 1, 0
+
+
+def frameDtype(frame):
+    """
+    Returns the dtype of frame's values in physical units.
+    """
+
+    if isinstance(frame, Frame):
+        return frame.dtype
+    return frameRawData(frame).dtype
+
+
+def frameShape(frame):
+    """
+    Returns the shape of frame's data, without reading the
+    data of a LazyFrame.
+    """
+
+    if isinstance(frame, Frame):
+        return frame.shape
+    return frameRawData(frame).shape
+
+
+def readTile(frame, rows, cols, out):
+    """
+    Copies the rows, cols tile of frame into out, in physical
+    units, without scaling a copy of the whole frame. Only
+    the tile is read from a LazyFrame that isn't resident.
+    """
+
+    bscale, bzero = frameScale(frame)
+    raw = frame.readSection(rows, cols) if isinstance(frame, Frame) else frameRawData(frame)[rows, cols]
+    return scaleInto(out, raw, bscale, bzero)
+
+
+def compactStackDtype(frames, correction=None):
+    """
+    Returns the dtype to stack compact frames in. Without a
+    correction, that is their own dtype in physical units,
+    so integer frames stay integers. With one, it is float32,
+    unless the frames are too wide for float32 to hold them
+    exactly, in which case it is float64.
+    """
+
+    dtype = np.result_type(*[frameDtype(f) for f in frames])
+    if correction is None:
+        return dtype
+    if (dtype.kind in 'iu' and dtype.itemsize <= 2) or (dtype == np.float32):
+        return np.dtype(np.float32)
+    return np.result_type(dtype, correction.dtype, np.float32)
+
+
+def tileSlices(shape, depth, itemsize, maxTileBytes=DEFAULT_MAX_TILE_BYTES):
+    """
+    Yields (rows, cols) slices covering a 2D detector of the
+    given shape, such that a (depth, rows, cols) stack of
+    itemsize-byte pixels fits in maxTileBytes. Tiles are full
+    width bands of rows, unless a single row is over the
+    budget, in which case each row is split into columns.
+    """
+
+    nRows, nCols = shape
+    rowBytes = depth * nCols * itemsize
+
+    if rowBytes <= maxTileBytes:
+        step = max(1, maxTileBytes // rowBytes)
+        for r0 in range(0, nRows, step):
+            yield slice(r0, min(r0 + step, nRows)), slice(0, nCols)
+    else:
+        step = max(1, maxTileBytes // (depth * itemsize))
+        for r0 in range(nRows):
+            for c0 in range(0, nCols, step):
+                yield slice(r0, r0 + 1), slice(c0, min(c0 + step, nCols))
+
+
+def combineTiled(frames, reducer, correction=None, maxTileBytes=DEFAULT_MAX_TILE_BYTES, workBytes=0,
+        dtype=None, outputDtype=None, window=None):
+    """
+    Combines frames along the stack axis one tile at a time.
+    Each tile of every frame is copied into a reused stack
+    buffer, corrected in place by subtracting the matching
+    tile of correction, and passed to reducer, which must
+    reduce a (N, rows, cols) stack over axis 0 and may
+    overwrite it. The result is written into a preallocated
+    output array.
+
+    The stack has the dtype numpy would give the full list
+    of frames (minus correction), so the result is the same
+    as reducing the whole stack at once, unless dtype is given
+    to stack them in instead (see compactStackDtype). Compact
+    frames are scaled one tile at a time. workBytes is the
+    extra memory per stack element the reducer needs for
+    its temporaries, and is counted against maxTileBytes.
+    With outputDtype, the result is cast to it tile by tile.
+
+    window, if given, is a (rows, cols) pair of slices of the
+    frames' data to combine, instead of all of it. correction
+    then has the shape of the window, as does the result.
+    Only the window is read from compressed LazyFrames.
+    """
+
+    if not frames:
+        raise ValueError("Empty list passed to combineTiled")
+    if (correction is not None) and (not isinstance(correction, np.ndarray)):
+        raise ValueError("kwarg correction must be None or numpy.ndarray")
+
+    depth = len(frames)
+    window, shape = _window(frames, window, 'combineTiled')
+
+    stackDtype = _stackDtype(frames, correction, dtype)
+
+    tiles = list(tileSlices(shape, depth, stackDtype.itemsize + workBytes, maxTileBytes))
+    maxTileSize = max((r.stop - r.start) * (c.stop - c.start) for r, c in tiles)
+    buffer = np.empty(depth * maxTileSize, dtype=stackDtype)
+    logger.debug(f"Combining {depth} frames of shape {shape} in {len(tiles)} tiles.")
+
+    out = None
+    for rows, cols in tiles:
+        tileShape = (rows.stop - rows.start, cols.stop - cols.start)
+        stack = buffer[:depth * tileShape[0] * tileShape[1]].reshape((depth,) + tileShape)
+        frameRows, frameCols = offsetRegion((rows, cols), window)
+        for i, f in enumerate(frames):
+            readTile(f, frameRows, frameCols, stack[i])
+            if correction is not None:
+                np.subtract(stack[i], correction[rows, cols], out=stack[i])
+
+        result = reducer(stack)
+        if out is None:
+            out = np.empty(shape, dtype=outputDtype or result.dtype)
+        out[rows, cols] = result
+
+    return out
+
+
+def combineParallel(frames, reducer, correction=None, maxTileBytes=DEFAULT_MAX_TILE_BYTES,
+        workBytes=0, maxWorkers=None, dtype=None, outputDtype=None, window=None):
+    """
+    Same as combineTiled, but the tiles are reduced by a pool
+    of maxWorkers processes. The frames, correction and output
+    are placed in shared memory once, so only the tile slices
+    are sent to the workers. Every pixel is reduced exactly as
+    combineTiled reduces it, so the results are identical.
+    Compact frames are held in shared memory in their own
+    dtype in physical units, e.g. uint16 rather than float.
+    """
+
+    if not frames:
+        raise ValueError("Empty list passed to combineParallel")
+    if (correction is not None) and (not isinstance(correction, np.ndarray)):
+        raise ValueError("kwarg correction must be None or numpy.ndarray")
+
+    depth = len(frames)
+    window, shape = _window(frames, window, 'combineParallel')
+
+    cubeDtype = np.result_type(*[frameDtype(f) for f in frames])
+    stackDtype = _stackDtype(frames, correction, dtype)
+    outDtype = outputDtype or reducer(np.zeros((depth, 1, 1), dtype=stackDtype)).dtype
+
+    ## Make enough tiles to keep every worker busy, within the tile budget.
+    itemsize = stackDtype.itemsize + workBytes
+    numWorkers = maxWorkers or os.cpu_count() or 1
+    stackBytes = depth * shape[0] * shape[1] * itemsize
+    tileBytes = min(maxTileBytes, max(1, stackBytes // (4 * numWorkers)))
+    tiles = list(tileSlices(shape, depth, itemsize, tileBytes))
+
+    blocks = []
+    try:
+        cube, cubeSpec = _sharedArray((depth,) + shape, cubeDtype, blocks)
+        for i, f in enumerate(frames):
+            readTile(f, *window, cube[i])
+        corrSpec = None
+        if correction is not None:
+            corr, corrSpec = _sharedArray(shape, correction.dtype, blocks)
+            corr[...] = correction
+        out, outSpec = _sharedArray(shape, outDtype, blocks)
+
+        logger.debug(f"Combining {depth} frames of shape {shape} in {len(tiles)} tiles over {maxWorkers} workers.")
+        with ProcessPoolExecutor(
+                max_workers=maxWorkers,
+                initializer=_initCombineWorker,
+                initargs=(cubeSpec, corrSpec, outSpec, reducer, stackDtype),
+                ) as executor:
+            ## Consume the results so worker exceptions are raised here.
+            for _ in executor.map(_combineTile, tiles):
+                pass
+
+        return np.array(out)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def _window(frames, window, caller):
+    """
+    Returns the resolved window of the frames to combine,
+    the whole frame if None, and its shape.
+    """
+    frameShape0 = frameShape(frames[0])
+    if len(frameShape0) != 2:
+        raise ValueError(f"{caller} needs 2D frames, got shape {frameShape0}")
+    window = resolveRegion(window, frameShape0)
+    return window, tuple(s.stop - s.start for s in window)
+
+
+def _stackDtype(frames, correction=None, dtype=None):
+    """
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    dtypes = [frameDtype(f) for f in frames]
+    if correction is not None:
+        dtypes.append(correction.dtype)
+    return np.result_type(*dtypes)
+
+
+def _sharedArray(shape, dtype, blocks):
+    """
+    Makes an array in a new shared memory block, appending
+    the block to blocks. Returns the array and the spec a
+    worker needs to attach to it.
+    """
+
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), (block.name, shape, dtype.str)
+
+
+## Shared arrays attached by each combine worker process.
+_workerState = {}
+
+
+def _attachShared(spec):
+    """
+    """
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _initCombineWorker(cubeSpec, corrSpec, outSpec, reducer, stackDtype):
+    """
+    """
+    _workerState.clear()
+    _workerState['blocks'] = []
+    for key, spec in (('cube', cubeSpec), ('correction', corrSpec), ('out', outSpec)):
+        if spec is None:
+            _workerState[key] = None
+            continue
+        block, array = _attachShared(spec)
+        _workerState['blocks'].append(block)
+        _workerState[key] = array
+    _workerState['reducer'] = reducer
+    _workerState['stackDtype'] = stackDtype
+
+
+def _combineTile(tile):
+    """
+    Reduces one tile of the shared cube into the shared output.
+    """
+    rows, cols = tile
+    cube = _workerState['cube']
+    correction = _workerState['correction']
+
+    stack = np.array(cube[:, rows, cols], dtype=_workerState['stackDtype'])
+    if correction is not None:
+        for i in range(stack.shape[0]):
+            np.subtract(stack[i], correction[rows, cols], out=stack[i])
+    _workerState['out'][rows, cols] = _workerState['reducer'](stack)
+
+
+def medianReducer(stack):
+    """
+    """
+    return np.median(stack, axis=0, overwrite_input=True)
+
+
+def meanReducer(stack):
+    """
+    """
+    return np.mean(stack, axis=0)
+
+
+def sigmaClipReducer(stack, sigma=3.0, maxIters=5):
+    """
+    Mean of each pixel after iteratively rejecting values
+    more than sigma standard deviations from the mean of
+    the values kept so far. Rejected values stay rejected.
+    Stops after maxIters passes, or once no more values are
+    rejected. Pixels left with no values, as small sigmas
+    can do, get the median of all of their values instead.
+    """
+    values = stack.astype(np.float64, copy=False)
+    keep = np.ones(stack.shape, dtype=bool)
+    count = np.full(stack.shape[1:], stack.shape[0])
+    mean = np.mean(values, axis=0)
+    deviation = np.empty_like(values)
+
+    for _ in range(maxIters):
+        np.subtract(values, mean, out=deviation)
+        np.abs(deviation, out=deviation)
+        ## Sums over the kept values, so pixels with none kept give 0 rather than NaN and a warning.
+        std = np.sqrt(np.sum(np.square(deviation), axis=0, where=keep) / np.maximum(count, 1))
+        newKeep = keep & (deviation <= sigma * std)
+        if np.array_equal(newKeep, keep):
+            break
+        keep = newKeep
+        count = keep.sum(axis=0)
+        mean = np.sum(values, axis=0, where=keep) / np.maximum(count, 1)
+
+    empty = count == 0
+    if empty.any():
+        mean[empty] = np.median(values[:, empty], axis=0)
+    return mean
+
+
+def minMaxReducer(stack, nLow=1, nHigh=1):
+    """
+    Mean of each pixel after rejecting its nLow lowest and
+    nHigh highest values.
+    """
+    depth = stack.shape[0]
+    if nLow + nHigh >= depth:
+        raise ValueError(f"Cannot reject {nLow} low and {nHigh} high values from {depth} frames.")
+    stack.sort(axis=0)
+    return np.mean(stack[nLow:depth - nHigh], axis=0)
+
+
+def percentileClipReducer(stack, low=10.0, high=90.0):
+    """
+    Mean of each pixel over the values between its low and
+    high percentiles, inclusive.
+    """
+    lower, upper = np.percentile(stack, [low, high], axis=0)
+    keep = (stack >= lower) & (stack <= upper)
+    return np.mean(stack, axis=0, where=keep, dtype=np.float64)
+
+
+## Combine methods by name, with the extra bytes per stack element each needs.
+COMBINE_METHODS = {
+        'median' : (medianReducer, 0),
+        'mean' : (meanReducer, 0),
+        'sigmaclip' : (sigmaClipReducer, 8 + 8 + 8 + 2),
+        'minmax' : (minMaxReducer, 0),
+        'percentileclip' : (percentileClipReducer, 8 + 8 + 1),
+        }
+
+
+def getReducer(combineMethod, **options):
+    """
+    Returns (reducer, workBytes) for combineMethod, with
+    options bound to the reducer.
+    """
+
+    try:
+        reducer, workBytes = COMBINE_METHODS[combineMethod]
+    except KeyError:
+        raise ValueError(f"Unknown combine method {combineMethod!r}. Choose from {list(COMBINE_METHODS)}.")
+    return partial(reducer, **options), workBytes
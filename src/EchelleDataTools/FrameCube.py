@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+__all__ = ['cubePaths', 'readFrameCube', 'writeFrameCube']
+
+
+from .Frame import CubeFrame, LazyFrame
+from .FrameCombine import frameRawData, frameScale, frameShape
+from .FrameRegion import parseRegion, regionSection
+from .Instrumentation import addToStage
+
+import astropy.io.fits as fits
+import json
+import logging
+import numpy as np
+import os
+import tempfile
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Bumped whenever the cube or index layout changes.
+CUBE_VERSION = 1
+
+
+def cubePaths(path):
+    """
+    Returns the cube and index file names for path, a file
+    name without extension, e.g. 'cubes/bias'.
+    """
+    return f"{path}.npy", f"{path}.json"
+
+
+def writeFrameCube(path, frames, label=None):
+    """
+    Writes frames into one contiguous (N, H, W) cube, a .npy
+    file that can be memory mapped, and their names, headers,
+    files, regions and scaling into a JSON index beside it.
+    See cubePaths. Frames are copied in one at a time, as
+    stored, so compact frames stay compact. A LazyFrame that
+    isn't resident is read with LazyFrame.readData, so it is
+    still not resident afterwards, and only one frame is in
+    memory at a time. Both files are replaced atomically.
+    Returns the cube and index file names.
+    """
+
+    if not frames:
+        raise ValueError("No frames to write to a cube.")
+    shape = frameShape(frames[0])
+    if any(frameShape(f) != shape for f in frames):
+        raise ValueError(f"Frames to write to a cube must all have the shape {shape}.")
+
+    dtype = np.result_type(*[_storedDtype(f) for f in frames]).newbyteorder('=')
+    cubeFile, indexFile = cubePaths(path)
+    directory = os.path.dirname(os.path.abspath(cubeFile))
+    os.makedirs(directory, exist_ok=True)
+
+    entries = []
+    tmpCube = tmpIndex = None
+    try:
+        fd, tmpCube = tempfile.mkstemp(dir=directory, suffix='.npy.tmp')
+        os.close(fd)
+        cube = np.lib.format.open_memmap(tmpCube, mode='w+', dtype=dtype, shape=(len(frames),) + tuple(shape))
+        for i, f in enumerate(frames):
+            cube[i] = _passData(f)
+            entries.append(_indexEntry(f))
+        cube.flush()
+        del cube
+
+        index = {
+                'version' : CUBE_VERSION,
+                'label' : label,
+                'shape' : [len(frames)] + list(shape),
+                'dtype' : dtype.str,
+                'frames' : entries,
+                }
+        fd, tmpIndex = tempfile.mkstemp(dir=directory, suffix='.json.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmpCube, cubeFile)
+        os.replace(tmpIndex, indexFile)
+    except Exception as e:
+        logger.error(f"Could not write frame cube {cubeFile}: {e}")
+        for tmpPath in (tmpCube, tmpIndex):
+            if (tmpPath is not None) and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        raise e
+
+    logger.info(f"Wrote {len(frames)} {label or ''} frames to {cubeFile}")
+    return cubeFile, indexFile
+
+
+def readFrameCube(path, mmapMode='r', checkSources=False):
+    """
+    Returns the (N, H, W) cube written by writeFrameCube to
+    path, and a list of CubeFrame objects whose data are
+    views of it. With the default mmapMode of 'r' the cube is
+    memory mapped read only, so nothing is copied; None reads
+    it into memory. With checkSources, raises ValueError if
+    a frame's FITS file has changed size or mtime since the
+    cube was written. Missing files are fine either way.
+    """
+
+    cubeFile, indexFile = cubePaths(path)
+    with open(indexFile, 'r') as f:
+        index = json.load(f)
+    if index.get('version') != CUBE_VERSION:
+        raise ValueError(f"Frame cube index {indexFile} is version {index.get('version')}, not {CUBE_VERSION}.")
+
+    cube = np.load(cubeFile, mmap_mode=mmapMode)
+    if (list(cube.shape) != index['shape']) or (cube.dtype.str != index['dtype']):
+        raise ValueError(f"Frame cube {cubeFile} doesn't match its index {indexFile}.")
+
+    frames = []
+    for i, entry in enumerate(index['frames']):
+        if checkSources:
+            _checkSource(entry)
+        frames.append(CubeFrame(
+                data=cube[i],
+                header=fits.Header.fromstring(entry['header']),
+                fileName=entry['fileName'],
+                hduIndex=entry['hduIndex'],
+                region=parseRegion(entry['region']),
+                bzero=entry['bzero'],
+                bscale=entry['bscale'],
+                name=entry['name'],
+                cubeFile=os.path.abspath(cubeFile),
+                cubeIndex=i,
+                ))
+    addToStage(frames=len(frames))
+    return cube, frames
+
+
+def _storedDtype(frame):
+    """
+    The dtype of frameRawData(frame), without reading the
+    data of a LazyFrame when its header gives it. Otherwise,
+    e.g. for a scaled float frame, its data is read and
+    dropped again, so it is read twice.
+    """
+    headerDtype = getattr(frame, '_headerDtype', None)
+    dtype = headerDtype() if headerDtype is not None else None
+    return dtype if dtype is not None else _passData(frame).dtype
+
+
+def _passData(frame):
+    """
+    """
+    if isinstance(frame, LazyFrame) and (not frame.isResident):
+        return frame.readData()
+    return frameRawData(frame)
+
+
+def _indexEntry(frame):
+    """
+    """
+    bscale, bzero = frameScale(frame)
+    entry = {
+            'name' : frame.name,
+            'fileName' : getattr(frame, 'fileName', None),
+            'hduIndex' : getattr(frame, 'hduIndex', 0),
+            'bzero' : bzero,
+            'bscale' : bscale,
+            'region' : None if frame.region is None else regionSection(frame.region),
+            'header' : frame.header.tostring() if getattr(frame, 'header', None) is not None else '',
+            'size' : None,
+            'mtime_ns' : None,
+            }
+    if entry['fileName'] is not None:
+        try:
+            st = os.stat(entry['fileName'])
+            entry['size'], entry['mtime_ns'] = st.st_size, st.st_mtime_ns
+        except OSError:
+            pass
+    return entry
+
+
+def _checkSource(entry):
+    """
+    """
+    if (entry['fileName'] is None) or (entry['size'] is None):
+        return
+    try:
+        st = os.stat(entry['fileName'])
+    except OSError:
+        return
+    if (st.st_size != entry['size']) or (st.st_mtime_ns != entry['mtime_ns']):
+        raise ValueError(f"{entry['fileName']} has changed since its frame cube was written.")
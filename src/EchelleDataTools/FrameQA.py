@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+__all__ = ['FrameQATable', 'frameMetrics', 'QA_METRICS']
+
+
+from .Frame import LazyFrame
+from .FrameCombine import frameDtype, frameRawData, frameScale
+from .FrameRegion import parseRegion, resolveRegion, subRegion
+
+import csv
+from dataclasses import dataclass, field, fields
+import io
+import logging
+import math
+import numpy as np
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Per-frame metrics, in physical units. saturated is a pixel count, overscan the median of the overscan region.
+QA_METRICS = ('mean', 'median', 'std', 'min', 'max', 'saturated', 'overscan')
+
+## Pixels of a frame taken at a time by the metrics pass.
+_QA_CHUNK_PIXELS = 1 << 22
+
+
+def frameMetrics(frame, saturation=None, overscan='BIASSEC'):
+    """
+    Returns a dict of the QA_METRICS of frame, a BaseFrame or
+    a 2D array, found in one pass over its data as stored.
+    Integer data of up to 16 bits is binned into a histogram
+    of every possible value, which gives all of the metrics
+    exactly. Wider and float data is read in chunks for the
+    moments and extremes, plus one np.partition for the
+    median; NaNs are left out.
+
+    saturated counts pixels at or above saturation, which
+    defaults to the SATURATE card of the frame's header, or
+    the largest value of an integer dtype. Float frames with
+    no SATURATE card have no saturation level, and a count
+    of 0. overscan is a region, as for FrameRegion.parseRegion,
+    defaulting to the BIASSEC card; its median is NaN if the
+    frame has no such region, or didn't load it.
+
+    A LazyFrame whose data isn't in memory is read with
+    LazyFrame.readData, so measuring it leaves it, and the
+    residency pool, as they were.
+    """
+
+    if isinstance(frame, LazyFrame) and (not frame.isResident):
+        raw = np.asarray(frame.readData())
+    else:
+        raw = np.asarray(frameRawData(frame))
+    bscale, bzero = frameScale(frame)
+    header = getattr(frame, 'header', None)
+
+    if saturation is None:
+        saturation = _defaultSaturation(frame, header)
+    rawSaturation = None
+    if saturation is not None:
+        rawSaturation = (saturation - bzero)/bscale
+
+    if (raw.dtype.kind in 'iu') and (raw.dtype.itemsize <= 2):
+        metrics = _histogramMetrics(raw, rawSaturation, bscale < 0)
+    else:
+        metrics = _chunkedMetrics(raw, rawSaturation, bscale < 0)
+
+    ## Every metric is linear in the raw values, except std, which only scales.
+    for key in ('mean', 'median', 'min', 'max'):
+        metrics[key] = bscale*metrics[key] + bzero
+    if bscale < 0:
+        metrics['min'], metrics['max'] = metrics['max'], metrics['min']
+    metrics['std'] = abs(bscale)*metrics['std']
+    metrics['overscan'] = _overscanLevel(frame, raw, header, overscan)
+    return metrics
+
+
+def _defaultSaturation(frame, header):
+    """
+    """
+    if (header is not None) and isinstance(header.get('SATURATE'), (int, float)):
+        return header['SATURATE']
+    dtype = np.dtype(frameDtype(frame))
+    if dtype.kind in 'iu':
+        return int(np.iinfo(dtype).max)
+    return None
+
+
+def _histogramMetrics(raw, rawSaturation, descending=False):
+    """
+    Metrics of integer data of up to 16 bits, from one
+    np.bincount pass over it in chunks. With descending (a
+    negative BSCALE), saturation counts pixels at or below
+    rawSaturation instead.
+    """
+    lo = int(np.iinfo(raw.dtype).min)
+    flat = raw.reshape(-1)
+    counts = np.zeros(1 << (8*raw.dtype.itemsize), dtype=np.int64)
+    for i0 in range(0, flat.size, _QA_CHUNK_PIXELS):
+        chunk = flat[i0:i0 + _QA_CHUNK_PIXELS].astype(np.int32) - lo
+        counts += np.bincount(chunk, minlength=counts.size)
+
+    n = int(flat.size)
+    if n == 0:
+        return {'mean' : math.nan, 'median' : math.nan, 'std' : math.nan, 'min' : math.nan, 'max' : math.nan,
+                'saturated' : 0}
+    values = np.arange(lo, lo + counts.size, dtype=np.float64)
+    occupied = np.flatnonzero(counts)
+    mean = float(counts @ values)/n
+    var = float(counts @ (values - mean)**2)/n
+
+    ## np.median averages the two middle values of an even count.
+    cumulative = np.cumsum(counts)
+    middle = np.searchsorted(cumulative, [(n - 1)//2 + 1, n//2 + 1])
+    median = (values[middle[0]] + values[middle[1]])/2
+
+    saturated = 0
+    if rawSaturation is not None:
+        if descending:
+            limit = math.floor(rawSaturation) - lo
+            saturated = int(counts[:max(0, min(counts.size, limit + 1))].sum())
+        else:
+            limit = math.ceil(rawSaturation) - lo
+            saturated = int(counts[max(0, limit):].sum()) if limit < counts.size else 0
+
+    return {
+            'mean' : mean,
+            'median' : float(median),
+            'std' : math.sqrt(var),
+            'min' : float(values[occupied[0]]),
+            'max' : float(values[occupied[-1]]),
+            'saturated' : saturated,
+            }
+
+
+def _chunkedMetrics(raw, rawSaturation, descending=False):
+    """
+    Metrics of any other data, read in chunks of pixels. The
+    per-chunk moments are merged with Chan's parallel update,
+    as in EchelleStatsTools.frameMoments.
+    """
+    flat = raw.reshape(-1)
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    lo = math.inf
+    hi = -math.inf
+    saturated = 0
+    for i0 in range(0, flat.size, _QA_CHUNK_PIXELS):
+        chunk = flat[i0:i0 + _QA_CHUNK_PIXELS]
+        if chunk.dtype.kind == 'f':
+            chunk = chunk[np.isfinite(chunk)]
+        if chunk.size == 0:
+            continue
+        chunkMean = float(chunk.mean(dtype=np.float64))
+        deviation = chunk.astype(np.float64) - chunkMean
+        chunkM2 = float(deviation @ deviation)
+
+        delta = chunkMean - mean
+        total = count + chunk.size
+        mean += delta*(chunk.size/total)
+        m2 += chunkM2 + delta**2*(count*chunk.size/total)
+        count = total
+        lo = min(lo, float(chunk.min()))
+        hi = max(hi, float(chunk.max()))
+        if rawSaturation is not None:
+            saturated += int(np.count_nonzero(chunk <= rawSaturation if descending else chunk >= rawSaturation))
+
+    if count == 0:
+        return {'mean' : math.nan, 'median' : math.nan, 'std' : math.nan, 'min' : math.nan, 'max' : math.nan,
+                'saturated' : 0}
+    return {'mean' : mean, 'median' : _median(flat), 'std' : math.sqrt(m2/count), 'min' : lo, 'max' : hi,
+            'saturated' : saturated}
+
+
+def _median(flat):
+    """
+    The median of the finite values of flat, with the two
+    middle values of an even count averaged in float64 rather
+    than in the dtype of flat, as np.median would.
+    """
+    if flat.dtype.kind == 'f':
+        flat = flat[np.isfinite(flat)]
+    n = flat.size
+    middle = [(n - 1)//2, n//2]
+    values = np.partition(flat, middle)[middle].astype(np.float64)
+    return float(values.mean())
+
+
+def _overscanLevel(frame, raw, header, overscan):
+    """
+    Returns the median of frame, whose data as stored is raw,
+    over the overscan region, in physical units, or NaN.
+    """
+    if (overscan is None) or (header is None) or ('NAXIS2' not in header):
+        return math.nan
+    try:
+        region = resolveRegion(parseRegion(overscan, header), (header['NAXIS2'], header['NAXIS1']))
+        rows, cols = subRegion(region, getattr(frame, 'region', None))
+    except ValueError as e:
+        logger.debug(f"No overscan level for {getattr(frame, 'name', None)}: {e}")
+        return math.nan
+
+    bscale, bzero = frameScale(frame)
+    return float(bscale*np.median(raw[rows, cols]) + bzero)
+
+
+@dataclass
+class FrameQATable:
+    """
+    Columnar table of the QA_METRICS of a set of frames, one
+    row per frame, as numpy arrays for vectorized selection:
+
+        qa = sequence.frameQA
+        sequence.rejectFrames((qa['category'] == 'Bias') & (qa['std'] > 10))
+
+    frames holds the frames themselves, in row order.
+    """
+    frames : list = field(default_factory=list, repr=False)
+    category : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    name : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    fileName : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    mean : np.ndarray = field(default_factory=lambda: np.empty(0))
+    median : np.ndarray = field(default_factory=lambda: np.empty(0))
+    std : np.ndarray = field(default_factory=lambda: np.empty(0))
+    min : np.ndarray = field(default_factory=lambda: np.empty(0))
+    max : np.ndarray = field(default_factory=lambda: np.empty(0))
+    saturated : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    overscan : np.ndarray = field(default_factory=lambda: np.empty(0))
+    rejected : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=bool))
+
+    @classmethod
+    def fromMetrics(cls, frames, categories, metrics):
+        """
+        Makes a table from lists of frames, their category
+        labels, and their frameMetrics dicts.
+        """
+        return cls(
+                frames=list(frames),
+                category=np.array(categories, dtype=object),
+                name=np.array([getattr(f, 'name', None) for f in frames], dtype=object),
+                fileName=np.array([getattr(f, 'fileName', None) for f in frames], dtype=object),
+                rejected=np.zeros(len(frames), dtype=bool),
+                **{
+                    key : np.array([m[key] for m in metrics], dtype=np.int64 if key == 'saturated' else np.float64)
+                    for key in QA_METRICS
+                    },
+                )
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Returns the rows of tables, in order, as one table.
+        """
+        tables = list(tables)
+        if not tables:
+            return cls()
+        return cls(
+                frames=[f for table in tables for f in table.frames],
+                **{column : np.concatenate([getattr(table, column) for table in tables]) for column in tables[0].columns},
+                )
+
+    @property
+    def columns(self):
+        """
+        """
+        return [f.name for f in fields(self) if f.name != 'frames']
+
+    def __getitem__(self, column):
+        """
+        """
+        if column not in self.columns:
+            raise KeyError(f"{column!r} is not a column of the frame QA table. Columns are {self.columns}.")
+        return getattr(self, column)
+
+    def __len__(self):
+        """
+        """
+        return len(self.frames)
+
+    def select(self, mask):
+        """
+        Returns a new table of the rows where mask is true.
+        """
+        mask = self._mask(mask)
+        return FrameQATable(
+                frames=[f for f, keep in zip(self.frames, mask) if keep],
+                **{column : getattr(self, column)[mask] for column in self.columns},
+                )
+
+    def _mask(self, mask):
+        """
+        Returns mask, or mask(self) if it is callable, as a
+        boolean array of one value per row.
+        """
+        if callable(mask):
+            mask = mask(self)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (len(self),):
+            raise ValueError(f"Mask of shape {mask.shape} doesn't match a table of {len(self)} frames.")
+        return mask
+
+    def toDict(self):
+        """
+        Returns the columns as lists.
+        """
+        return {column : getattr(self, column).tolist() for column in self.columns}
+
+    def toCSV(self, path=None):
+        """
+        Returns the table as CSV, and writes it to path if given.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(self.columns)
+        writer.writerows(zip(*[getattr(self, column).tolist() for column in self.columns]))
+        text = buffer.getvalue()
+        if path is not None:
+            with open(path, 'w', newline='') as f:
+                f.write(text)
+        return text
+
+    def __str__(self):
+        """
+        """
+        lines = [f"{'category':<10} {'name':<14} {'mean':>10} {'median':>10} {'std':>9} {'min':>9} {'max':>9} "
+                f"{'saturated':>9} {'overscan':>9} rejected"]
+        for i in range(len(self)):
+            lines.append(
+                    f"{str(self.category[i]):<10} {str(self.name[i]):<14} {self.mean[i]:>10.2f} {self.median[i]:>10.2f} "
+                    f"{self.std[i]:>9.2f} {self.min[i]:>9.1f} {self.max[i]:>9.1f} {self.saturated[i]:>9d} "
+                    f"{self.overscan[i]:>9.2f} {bool(self.rejected[i])}"
+                    )
+        return '\n'.join(lines)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+__all__ = ['offsetRegion', 'parseRegion', 'regionSection', 'resolveRegion', 'subRegion']
+
+
+import logging
+import re
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## One axis of a FITS section: '*', 'n' or 'n1:n2'.
+_SECTION_AXIS = re.compile(r'^\s*(\*|\d+)(?:\s*:\s*(\d+))?\s*$')
+
+
+def parseRegion(spec, header=None):
+    """
+    Returns the (rows, cols) slices of a detector region, in
+    numpy order, or None for the whole detector. spec is one
+    of:
+
+        None
+        a (rows, cols) pair of slices, 0-based and end exclusive
+        a FITS section string '[x1:x2,y1:y2]', 1-based and
+            inclusive, with x along columns; '*' is a whole axis
+        the name of a header card holding a FITS section,
+            e.g. 'BIASSEC' for the overscan, read from header
+    """
+
+    if spec is None:
+        return None
+
+    if isinstance(spec, str):
+        if not spec.strip().startswith('['):
+            if (header is None) or (spec not in header):
+                raise ValueError(f"Region card {spec!r} is not in the header.")
+            return parseRegion(header[spec])
+        return _parseSection(spec)
+
+    try:
+        rows, cols = spec
+    except (TypeError, ValueError):
+        raise ValueError(f"Region must be a FITS section or a (rows, cols) pair of slices, not {spec!r}")
+    if not (isinstance(rows, slice) and isinstance(cols, slice)):
+        raise ValueError(f"Region must be a FITS section or a (rows, cols) pair of slices, not {spec!r}")
+    return rows, cols
+
+
+def _parseSection(section):
+    """
+    """
+    text = section.strip()
+    if not (text.startswith('[') and text.endswith(']')):
+        raise ValueError(f"Malformed FITS section {section!r}")
+    axes = text[1:-1].split(',')
+    if len(axes) != 2:
+        raise ValueError(f"FITS section {section!r} must have two axes.")
+
+    ## FITS sections list x (columns) first.
+    slices = []
+    for axis in axes:
+        match = _SECTION_AXIS.match(axis)
+        if match is None:
+            raise ValueError(f"Malformed FITS section {section!r}")
+        first, last = match.groups()
+        if first == '*':
+            slices.append(slice(None))
+            continue
+        first = int(first)
+        last = first if last is None else int(last)
+        if (first < 1) or (last < first):
+            raise ValueError(f"FITS section {section!r} must count up from 1.")
+        slices.append(slice(first - 1, last))
+    cols, rows = slices
+    return rows, cols
+
+
+def resolveRegion(region, shape):
+    """
+    Returns region with explicit starts and stops within a
+    detector of the given (rows, cols) shape. None is the
+    whole detector. Raises ValueError for steps other than
+    1, and for regions outside or empty on the detector.
+    """
+
+    if region is None:
+        region = (slice(None), slice(None))
+
+    resolved = []
+    for s, n in zip(region, shape):
+        if s.step not in (None, 1):
+            raise ValueError(f"Region slices must have a step of 1, not {s.step}")
+        if (s.stop is not None) and (s.stop > n):
+            raise ValueError(f"Region {regionSection(region)} is outside a detector of shape {tuple(shape)}")
+        start, stop, _ = s.indices(n)
+        if stop <= start:
+            raise ValueError(f"Region {regionSection(region)} is empty on a detector of shape {tuple(shape)}")
+        resolved.append(slice(start, stop))
+    return tuple(resolved)
+
+
+def subRegion(region, within):
+    """
+    Returns the slices selecting region from the data of a
+    frame covering within, where both are resolved regions
+    in detector coordinates. within None is the whole
+    detector. Raises ValueError if region is not inside it.
+    """
+
+    if within is None:
+        return region
+
+    local = []
+    for s, w in zip(region, within):
+        if (s.start < w.start) or (s.stop > w.stop):
+            raise ValueError(f"Region {regionSection(region)} is not inside {regionSection(within)}")
+        local.append(slice(s.start - w.start, s.stop - w.start))
+    return tuple(local)
+
+
+def offsetRegion(local, within):
+    """
+    The inverse of subRegion. Returns the detector region
+    selected by the local slices of the data of a frame
+    covering within.
+    """
+
+    if within is None:
+        return local
+
+    local = resolveRegion(local, [w.stop - w.start for w in within])
+    return tuple(slice(s.start + w.start, s.stop + w.start) for s, w in zip(local, within))
+
+
+def regionSection(region):
+    """
+    Returns region as a FITS section string '[x1:x2,y1:y2]'.
+    """
+
+    if region is None:
+        return '[*,*]'
+
+    axes = []
+    for s in (region[1], region[0]):
+        if (s.start is None) and (s.stop is None):
+            axes.append('*')
+        else:
+            axes.append(f"{(s.start or 0) + 1}:{'' if s.stop is None else s.stop}")
+    return f"[{','.join(axes)}]"
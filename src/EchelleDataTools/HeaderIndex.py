@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+__all__ = ['HeaderIndex']
+
+
+import csv
+from dataclasses import dataclass, field
+import io
+import logging
+import math
+import numpy as np
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+def _cardColumn(card, values):
+    """
+    Returns values, one per file (None where the card is
+    missing), as a numpy column: datetime64[ms] for DATE
+    cards, float64 when every value is a number, and object
+    otherwise. Missing values are NaT, NaN or None.
+    """
+
+    present = [v for v in values if v is not None]
+    if card.startswith('DATE'):
+        return np.array([_parseDate(v) for v in values], dtype='datetime64[ms]')
+    if present and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return np.array([math.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+def _parseDate(value):
+    """
+    """
+    if not isinstance(value, str):
+        return np.datetime64('NaT')
+    try:
+        ## numpy warns about time zones, and FITS dates are UTC anyway.
+        return np.datetime64(value.strip().rstrip('Z'), 'ms')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+@dataclass
+class HeaderIndex:
+    """
+    Columnar index of the header cards of the scanned files,
+    one row per file in fitsList order, built by
+    EchelleDataSequenceConfiguration. fileName and category
+    (see EchelleDataSequence.FRAME_CATEGORIES, None for files
+    that weren't classified) are object arrays. Each card is
+    a column named after it; see _cardColumn for its dtype.
+    Selections are vectorized masks over the rows, e.g. the
+    darks with EXPTIME=600 taken after 03:00 UT on the night
+    of 2025-08-17:
+
+        index = config.headerIndex
+        index.select((index['category'] == 'dark') & (index['EXPTIME'] == 600)
+                & (index['DATE-OBS'] >= np.datetime64('2025-08-18T03:00')))
+
+    Compare dates against a full datetime64 like this, rather
+    than a time of day, which wraps at UT midnight.
+    """
+    fileName : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    category : np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    cards : dict = field(default_factory=dict)
+
+    @classmethod
+    def fromCards(cls, fileNames, categories, cardValues, cards):
+        """
+        Makes an index from lists of file names, their
+        categories and their dicts of card values, with a
+        column for each of cards.
+        """
+        return cls(
+                fileName=np.array(fileNames, dtype=object),
+                category=np.array(categories, dtype=object),
+                cards={card : _cardColumn(card, [values.get(card) for values in cardValues]) for card in cards},
+                )
+
+    @property
+    def columns(self):
+        """
+        """
+        return ['fileName', 'category'] + list(self.cards)
+
+    def __getitem__(self, column):
+        """
+        """
+        if column in ('fileName', 'category'):
+            return getattr(self, column)
+        if column not in self.cards:
+            raise KeyError(f"{column!r} is not a column of the header index. Columns are {self.columns}.")
+        return self.cards[column]
+
+    def __len__(self):
+        """
+        """
+        return len(self.fileName)
+
+    def select(self, mask):
+        """
+        Returns a new index of the rows where mask is true.
+        mask is a boolean array of one value per row, or a
+        function of the index returning one.
+        """
+        return self.take(np.flatnonzero(self._mask(mask)))
+
+    def take(self, rows):
+        """
+        Returns a new index of rows, an array of row numbers.
+        """
+        return HeaderIndex(
+                fileName=self.fileName[rows],
+                category=self.category[rows],
+                cards={card : column[rows] for card, column in self.cards.items()},
+                )
+
+    def _mask(self, mask):
+        """
+        """
+        if callable(mask):
+            mask = mask(self)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (len(self),):
+            raise ValueError(f"Mask of shape {mask.shape} doesn't match an index of {len(self)} files.")
+        return mask
+
+    def rows(self, fileNames):
+        """
+        Returns the row of each of fileNames, or -1 for files
+        not in the index.
+        """
+        lookup = {name : i for i, name in enumerate(self.fileName)}
+        return np.array([lookup.get(name, -1) for name in fileNames], dtype=np.intp)
+
+    def timeOfDay(self, card='DATE-OBS'):
+        """
+        Returns the time of day of a date card in hours, e.g.
+        3.5 for 03:30, NaN where it is missing. It wraps at UT
+        midnight, so on a night crossing it, timeOfDay() >= 3
+        also selects the evening's frames, e.g. 23:00. Compare
+        the card against a full datetime64 to select frames
+        after a time of a given night.
+        """
+        dates = self[card]
+        hours = (dates - dates.astype('datetime64[D]')) / np.timedelta64(1, 'h')
+        return np.where(np.isnat(dates), np.nan, hours)
+
+    def groups(self, by, mask=None):
+        """
+        Returns a dict of the rows of each distinct value of the
+        column by, or of each distinct tuple of values of a list
+        of columns, in order of first appearance. Rows missing
+        any of the values are left out, as are rows where mask,
+        if given, is false.
+        """
+        columns = [by] if isinstance(by, str) else list(by)
+        values = [self[column] for column in columns]
+        keep = np.ones(len(self), dtype=bool) if mask is None else self._mask(mask).copy()
+        for column in values:
+            keep &= ~_missing(column)
+
+        groups = {}
+        for i in np.flatnonzero(keep):
+            key = tuple(_keyValue(column[i]) for column in values)
+            groups.setdefault(key if len(key) > 1 else key[0], []).append(i)
+        return {key : np.array(rows, dtype=np.intp) for key, rows in groups.items()}
+
+    def toDict(self):
+        """
+        Returns the columns as lists, with dates as ISO strings.
+        """
+        return {column : _columnList(self[column]) for column in self.columns}
+
+    def toCSV(self, path=None):
+        """
+        Returns the index as CSV, and writes it to path if given.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(self.columns)
+        writer.writerows(zip(*[_columnList(self[column]) for column in self.columns]))
+        text = buffer.getvalue()
+        if path is not None:
+            with open(path, 'w', newline='') as f:
+                f.write(text)
+        return text
+
+
+def _missing(column):
+    """
+    """
+    if column.dtype.kind == 'M':
+        return np.isnat(column)
+    if column.dtype.kind == 'f':
+        return np.isnan(column)
+    return np.array([v is None for v in column], dtype=bool)
+
+
+def _keyValue(value):
+    """
+    Group keys are plain Python values, with whole floats as
+    ints, e.g. 600 rather than np.float64(600.0).
+    """
+    if isinstance(value, np.datetime64):
+        return str(value)
+    if isinstance(value, np.floating):
+        return int(value) if value.is_integer() else float(value)
+    return value
+
+
+def _columnList(column):
+    """
+    """
+    if column.dtype.kind == 'M':
+        return [None if np.isnat(v) else str(v) for v in column]
+    return column.tolist()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+Stage-level timing and memory instrumentation.
+
+    with instrumented() as report:
+        sequence = EchelleDataSequence(dataRoot)
+        sequence.loadFrames()
+        sequence.makeSuperBias()
+    print(report)
+    report.toCSV('stages.csv')
+
+While instrumentation is enabled, the configuration scan,
+each category of loadFrames or importFrameCubes, each frame
+cube export, the frame QA pass, each super frame combine,
+each grouped makeSuperFrames call, the statistics classes,
+the plot functions and calibrateFrames each record a
+StageRecord of their wall time, bytes read from files,
+frames processed and peak resident memory.
+When it is disabled, which is the default, a stage costs a
+global lookup and an empty context manager.
+"""
+
+__all__ = ['StageRecord', 'StageReport', 'addToStage', 'disableInstrumentation', 'enableInstrumentation',
+        'headerBytes', 'instrumented', 'stage', 'timedStage']
+
+
+from contextlib import contextmanager
+import csv
+from dataclasses import asdict, dataclass, field, fields
+import functools
+import io
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## FITS files are read in blocks of this many bytes.
+FITS_BLOCK = 2880
+
+
+@dataclass
+class StageRecord:
+    """
+    One run of a stage. start is in seconds from when the
+    report was made, and wallTime is None until the stage
+    ends. bytesRead, frames and peakMemory include those of
+    any stages nested in it, whose parent is the index of
+    this record in StageReport.records. peakMemory is the
+    resident memory high-water mark of the process during
+    the stage, and startMemory its resident memory at the
+    start, both in bytes. Worker processes are not included.
+    """
+    stage : str
+    label : str = None
+    start : float = 0.0
+    wallTime : float = None
+    bytesRead : int = 0
+    frames : int = 0
+    startMemory : int = None
+    peakMemory : int = None
+    depth : int = 0
+    parent : int = None
+    thread : str = None
+
+
+@dataclass
+class StageReport:
+    """
+    The StageRecord of every stage run while the report was
+    enabled, in the order the stages started.
+    """
+    records : list[StageRecord] = field(default_factory=list)
+    origin : float = field(default_factory=time.perf_counter, repr=False)
+
+    def stages(self, name):
+        """
+        Returns the records of the stage called name.
+        """
+        return [r for r in self.records if r.stage == name]
+
+    def totals(self):
+        """
+        Returns a dict of the total wall time, bytes read and
+        frames, and the largest peak memory, of each stage, by
+        stage name. Stages nested in one of the same name are
+        already counted in it, so are left out.
+        """
+        totals = {}
+        for record in self.records:
+            if self._nestedInSame(record):
+                continue
+            total = totals.setdefault(record.stage, {'count' : 0, 'wallTime' : 0.0, 'bytesRead' : 0, 'frames' : 0,
+                    'peakMemory' : None})
+            total['count'] += 1
+            total['wallTime'] += record.wallTime or 0.0
+            total['bytesRead'] += record.bytesRead
+            total['frames'] += record.frames
+            if record.peakMemory is not None:
+                total['peakMemory'] = max(total['peakMemory'] or 0, record.peakMemory)
+        return totals
+
+    def toDict(self):
+        """
+        """
+        return {
+                'platform' : sys.platform,
+                'records' : [asdict(r) for r in self.records],
+                'totals' : self.totals(),
+                }
+
+    def toJSON(self, path=None, indent=2):
+        """
+        Returns the report as JSON, and writes it to path if given.
+        """
+        text = json.dumps(self.toDict(), indent=indent)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def toCSV(self, path=None):
+        """
+        Returns the records as CSV, one row per stage run, and
+        writes them to path if given.
+        """
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=[f.name for f in fields(StageRecord)], lineterminator='\n')
+        writer.writeheader()
+        for record in self.records:
+            writer.writerow(asdict(record))
+        text = buffer.getvalue()
+        if path is not None:
+            with open(path, 'w', newline='') as f:
+                f.write(text)
+        return text
+
+    def clear(self):
+        """
+        """
+        self.records.clear()
+        self.origin = time.perf_counter()
+
+    def _nestedInSame(self, record):
+        """
+        """
+        parent = record.parent
+        while parent is not None:
+            if self.records[parent].stage == record.stage:
+                return True
+            parent = self.records[parent].parent
+        return False
+
+    def __str__(self):
+        """
+        """
+        lines = [f"{'stage':<24} {'label':<24} {'wall [s]':>10} {'read [MB]':>10} {'frames':>7} {'peak [MB]':>10}"]
+        for record in self.records:
+            lines.append(
+                    f"{'  '*record.depth + record.stage:<24} {str(record.label or ''):<24} "
+                    f"{_format(record.wallTime, 1, '.4f'):>10} {_format(record.bytesRead, 1 << 20, '.2f'):>10} "
+                    f"{record.frames:>7} {_format(record.peakMemory, 1 << 20, '.1f'):>10}"
+                    )
+        return '\n'.join(lines)
+
+
+def _format(value, unit, spec):
+    """
+    """
+    return '-' if value is None else format(value/unit, spec)
+
+
+## The enabled report, or None. Checked first by everything below, so disabled stages cost next to nothing.
+_report = None
+
+## Stages open in any thread, oldest first, and the lock guarding them and their records.
+_openStages = []
+_lock = threading.Lock()
+
+## Stages open in each thread, innermost last.
+_local = threading.local()
+
+
+class _NullStage(object):
+    """
+    What stage returns while instrumentation is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        return False
+
+    def add(self, bytesRead=0, frames=0):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """
+    """
+
+    def __init__(self, report, name, label=None, frames=0):
+        self.report = report
+        self.record = StageRecord(stage=name, label=label, frames=frames, thread=threading.current_thread().name)
+        self.parent = None
+
+    def __enter__(self):
+        stack = _threadStages()
+        with _lock:
+            self.parent = stack[-1] if stack else None
+            ## Fold the high-water mark so far into the open stages before resetting it for this one.
+            _foldPeak()
+            reset = _resetPeakMemory()
+            record = self.record
+            record.start = time.perf_counter() - self.report.origin
+            record.depth = 0 if self.parent is None else self.parent.record.depth + 1
+            record.startMemory = _currentMemory()
+            record.peakMemory = record.startMemory if reset else _peakMemory()
+            if (self.parent is not None) and (self.parent.report is self.report):
+                record.parent = self.parent.index
+            self.index = len(self.report.records)
+            self.report.records.append(record)
+            _openStages.append(self)
+        stack.append(self)
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *excInfo):
+        self.record.wallTime = time.perf_counter() - self._t0
+        stack = _threadStages()
+        if stack and (stack[-1] is self):
+            stack.pop()
+        with _lock:
+            _foldPeak()
+            _openStages.remove(self)
+        return False
+
+    def add(self, bytesRead=0, frames=0):
+        """
+        Adds to the counts of this stage and the stages it is nested in.
+        """
+        with _lock:
+            s = self
+            while s is not None:
+                s.record.bytesRead += bytesRead
+                s.record.frames += frames
+                s = s.parent
+
+
+def _threadStages():
+    """
+    """
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+    return stack
+
+
+def _foldPeak():
+    """
+    Raises the peakMemory of every open stage to the current
+    high-water mark. Called with _lock held.
+    """
+    if not _openStages:
+        return
+    peak = _peakMemory()
+    if peak is None:
+        return
+    for s in _openStages:
+        if (s.record.peakMemory is None) or (peak > s.record.peakMemory):
+            s.record.peakMemory = peak
+
+
+def _resetPeakMemory():
+    """
+    Resets the process's resident memory high-water mark, if
+    the kernel supports it (Linux). Returns whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _statusBytes(key):
+    """
+    Returns a memory line of /proc/self/status in bytes, or None.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peakMemory():
+    """
+    """
+    peak = _statusBytes('VmHWM:')
+    if peak is not None:
+        return peak
+    if resource is None:
+        return None
+    ## ru_maxrss is in kB on Linux, bytes on macOS. It can't be reset.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _currentMemory():
+    """
+    """
+    return _statusBytes('VmRSS:')
+
+
+def enableInstrumentation(report=None):
+    """
+    Starts recording stages into report, or a new StageReport,
+    and returns it.
+    """
+    global _report
+    _report = report if report is not None else StageReport()
+    return _report
+
+
+def disableInstrumentation():
+    """
+    Stops recording stages, and returns the report they were
+    recorded in, or None if instrumentation wasn't enabled.
+    """
+    global _report
+    report, _report = _report, None
+    return report
+
+
+@contextmanager
+def instrumented(report=None):
+    """
+    Records the stages run in the with block into report, or
+    a new StageReport, which is returned. Instrumentation
+    enabled outside the block is enabled again after it.
+    """
+    global _report
+    previous = _report
+    report = enableInstrumentation(report)
+    try:
+        yield report
+    finally:
+        _report = previous
+
+
+def stage(name, label=None, frames=0):
+    """
+    Returns a context manager recording a stage called name,
+    e.g. 'load', with a label telling runs of it apart, e.g.
+    the frame category. frames is the number of frames the
+    stage processes, if known up front; more can be added
+    with addToStage, or the add method of the stage.
+    """
+    report = _report
+    if report is None:
+        return _NULL_STAGE
+    return _Stage(report, name, label=label, frames=frames)
+
+
+def timedStage(name, label=None):
+    """
+    Decorator recording each call of a function as a stage
+    called name, labelled with label or the function's name.
+    """
+    def decorate(function):
+        stageLabel = label or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _report is None:
+                return function(*args, **kwargs)
+            with _Stage(_report, name, label=stageLabel):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def addToStage(bytesRead=0, frames=0):
+    """
+    Adds bytes read and frames processed to the innermost
+    stage open in this thread, or if there is none, to the
+    latest stage opened in any thread, e.g. the one that
+    started the thread pool this is called from.
+    """
+    if _report is None:
+        return
+    stack = _threadStages()
+    if stack:
+        current = stack[-1]
+    else:
+        with _lock:
+            current = _openStages[-1] if _openStages else None
+    if current is not None:
+        current.add(bytesRead=bytesRead, frames=frames)
+
+
+def headerBytes(header):
+    """
+    Returns the size of header in a FITS file: its cards and
+    END card, padded to whole blocks.
+    """
+    return -(-80*(len(header) + 1) // FITS_BLOCK) * FITS_BLOCK
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+__all__ = ['SuperFrameCache']
+
+
+from .EchelleDataSequenceConfiguration import _userCacheDir
+from .Frame import Frame, SuperFrame
+from .FrameRegion import parseRegion, regionSection
+from .Instrumentation import addToStage, headerBytes
+
+import astropy.io.fits as fits
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import tempfile
+
+
+logger = logging.getLogger(f"{__name__}")
+
+
+## Bumped whenever the key recipe or the file layout changes.
+CACHE_VERSION = 4
+
+
+class SuperFrameCache(object):
+    """
+    On-disk cache of SuperFrame objects, stored as FITS files
+    named by a provenance key. The key is a hash of the input
+    files with their sizes and mtimes, the combine method and
+    options, the bias/dark subtraction flags, and the keys of
+    the super frames used as corrections. Files are evicted
+    least recently used first once the cache is over maxBytes.
+    """
+
+    def __init__(self, cacheDir=None, maxBytes=4 * (1 << 30)):
+        """
+        cacheDir defaults to a directory in the user cache
+        directory. A maxBytes of None means no limit.
+        """
+        self.cacheDir = cacheDir or os.path.join(_userCacheDir(), 'superframes')
+        self.maxBytes = maxBytes
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+    def makeKey(self, frames, name=None, combineMethod='median', combineOptions=None,
+            biasSubtracted=None, darkSubtracted=None, correctionFrames=(), stackDtype=None, outputDtype=None,
+            region=None):
+        """
+        Returns the provenance key for combining frames, or None
+        if a frame doesn't come from a file on disk, in which
+        case the result can't be cached. stackDtype and
+        outputDtype are the dtypes the frames are combined in
+        and the result is cast to, if not the defaults. region
+        is the detector region combined, None for all of it.
+        """
+        inputs = []
+        for f in frames:
+            fileName = getattr(f, 'fileName', None) if isinstance(f, Frame) else None
+            if fileName is None:
+                logger.debug(f"Frame {getattr(f, 'name', None)} has no file. Not caching.")
+                return None
+            try:
+                st = os.stat(fileName)
+            except OSError:
+                return None
+            inputs.append([os.path.abspath(fileName), st.st_size, st.st_mtime_ns])
+
+        corrections = [
+                c.provenance or hashlib.sha1(np.ascontiguousarray(c.data)).hexdigest()
+                for c in correctionFrames
+                ]
+
+        recipe = {
+                'version' : CACHE_VERSION,
+                'name' : name,
+                'inputs' : inputs,
+                'combineMethod' : combineMethod,
+                'combineOptions' : combineOptions or {},
+                'biasSubtracted' : biasSubtracted,
+                'darkSubtracted' : darkSubtracted,
+                'corrections' : corrections,
+                'stackDtype' : None if stackDtype is None else np.dtype(stackDtype).name,
+                'outputDtype' : None if outputDtype is None else np.dtype(outputDtype).name,
+                'region' : None if region is None else regionSection(region),
+                }
+        return hashlib.sha1(json.dumps(recipe, sort_keys=True, default=str).encode()).hexdigest()
+
+    def load(self, key):
+        """
+        Returns the cached SuperFrame for key, or None.
+        """
+        path = self._path(key)
+        try:
+            with fits.open(path, memmap=False) as hdul:
+                ## FITS is big-endian; hand back native byte order like a fresh combine.
+                data = hdul[0].data.astype(hdul[0].data.dtype.newbyteorder('='))
+                header = hdul[0].header
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Could not read cached super frame {path}: {e}. Discarding it.")
+            self.invalidate(key)
+            return None
+
+        ## Mark as recently used for eviction.
+        os.utime(path)
+        addToStage(bytesRead=headerBytes(header) + data.nbytes)
+        return SuperFrame(
+                data=data,
+                name=header.get('FRAMNAME') or None,
+                biasSubtracted=_fromCard(header, 'BIASSUB'),
+                darkSubtracted=_fromCard(header, 'DARKSUB'),
+                combineMethod=header.get('COMBMETH', 'median'),
+                combineOptions=json.loads(header.get('COMBOPTS', '{}')),
+                outputDtype=header.get('OUTDTYPE') or None,
+                region=parseRegion(header.get('REGION') or None),
+                exposureTime=header.get('EXPTIME') if header.get('EXPTIME', '') != '' else None,
+                provenance=key,
+                )
+
+    def store(self, key, superFrame):
+        """
+        Writes superFrame to the cache under key, then evicts
+        old entries if over maxBytes. Failing to write is not
+        fatal, since the super frame has already been made.
+        """
+        header = fits.Header()
+        header['FRAMNAME'] = superFrame.name or ''
+        header['BIASSUB'] = _toCard(superFrame.biasSubtracted)
+        header['DARKSUB'] = _toCard(superFrame.darkSubtracted)
+        header['COMBMETH'] = superFrame.combineMethod
+        header['COMBOPTS'] = json.dumps(superFrame.combineOptions or {}, sort_keys=True)
+        header['OUTDTYPE'] = superFrame.outputDtype or ''
+        header['REGION'] = '' if superFrame.region is None else regionSection(superFrame.region)
+        header['EXPTIME'] = '' if superFrame.exposureTime is None else superFrame.exposureTime
+        header['PROVKEY'] = key
+
+        tmpPath = None
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                fits.PrimaryHDU(data=superFrame.data, header=header).writeto(f)
+            os.replace(tmpPath, self._path(key))
+        except Exception as e:
+            logger.warning(f"Could not write {superFrame.name} to the super frame cache: {e}")
+            if (tmpPath is not None) and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+        self._evict(keep=key)
+
+    def invalidate(self, key=None):
+        """
+        Removes the entry for key, or every entry if key is None.
+        """
+        keys = [key] if key is not None else [k for k, _, _ in self._entries()]
+        for k in keys:
+            try:
+                os.remove(self._path(k))
+            except FileNotFoundError:
+                pass
+
+    def _entries(self):
+        """
+        Returns (key, size, mtime) for each cached file, oldest first.
+        """
+        entries = []
+        for fileName in os.listdir(self.cacheDir):
+            if not fileName.endswith('.fits'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cacheDir, fileName))
+            except FileNotFoundError:
+                continue
+            entries.append((fileName[:-len('.fits')], st.st_size, st.st_mtime_ns))
+        return sorted(entries, key=lambda e: e[2])
+
+    def _evict(self, keep=None):
+        """
+        """
+        if self.maxBytes is None:
+            return
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.maxBytes:
+                break
+            if key == keep:
+                continue
+            logger.debug(f"Evicting {key} from the super frame cache.")
+            self.invalidate(key)
+            total -= size
+
+    def _path(self, key):
+        """
+        """
+        return os.path.join(self.cacheDir, f"{key}.fits")
+
+    def __repr__(self):
+        """
+        """
+        return f"SuperFrameCache(cacheDir={self.cacheDir!r}, maxBytes={self.maxBytes})"
+
+
+def _toCard(flag):
+    """
+    FITS cards can't hold None, so an unset flag is stored as ''.
+    """
+    return '' if flag is None else bool(flag)
+
+
+def _fromCard(header, card):
+    """
+    """
+    value = header.get(card, '')
+    return None if value == '' else bool(value)
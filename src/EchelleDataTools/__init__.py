@@ -2,16 +2,53 @@
 
 __all__ = ['EchelleDataSequence', 'EchellePlotTools', 'EchelleStatsTools']
 
+import importlib as _importlib
 import logging as _logging
 import sys as _sys
 
-_logging.basicConfig(
-        level=_logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        stream=_sys.stdout,
-        )
+## Log records go nowhere until the application configures logging, e.g. with configureLogging.
+_logging.getLogger(__name__).addHandler(_logging.NullHandler())
 
 from EchelleDataTools.EchelleDataSequence import EchelleDataSequence
 from EchelleDataTools.EchelleDataSequenceConfiguration import EchelleDataSequenceConfiguration
-from EchelleDataTools.EchellePlotTools import EchellePlotTools
-from EchelleDataTools.EchelleStatsTools import EchelleStatsTools
+from EchelleDataTools.SuperFrameCache import SuperFrameCache
+from EchelleDataTools.Instrumentation import StageReport, disableInstrumentation, enableInstrumentation, instrumented
+
+
+## Modules imported on first access, since they pull in matplotlib and scipy.
+_LAZY_MODULES = {
+        'EchellePlotTools' : 'EchelleDataTools.EchellePlotTools.EchellePlotTools',
+        'EchelleStatsTools' : 'EchelleDataTools.EchelleStatsTools.EchelleStatsTools',
+        }
+
+
+def __getattr__(name):
+    """
+    """
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = _importlib.import_module(_LAZY_MODULES[name])
+    ## Importing the subpackage binds it here; bind the module instead, as an eager import did.
+    globals()[name] = module
+    return module
+
+
+def __dir__():
+    """
+    """
+    return sorted(set(globals()) | set(_LAZY_MODULES))
+
+
+def configureLogging(level=_logging.INFO, stream=None,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'):
+    """
+    Sends log records of level and above to stream, stdout by
+    default, through logging.basicConfig. Importing the
+    package no longer does this, so applications, and worker
+    processes, keep their own logging setup.
+    """
+    _logging.basicConfig(
+            level=level,
+            format=format,
+            stream=stream if stream is not None else _sys.stdout,
+            )